@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+DataLoader autotuning.
+
+Profiles short training runs on the current machine over batch size, worker
+count and prefetch factor, one knob at a time, and keeps the fastest setting
+(samples per second) that stays within the memory limit. Results are saved
+per host in config.autotune_file and reused by later runs.
+'''
+import os, json, time, copy, socket
+import torch
+from config import config
+from loader import make_loader, supports_prefetch_factor
+import utils
+import precision
+
+
+def _host_key(model_name, device):
+    gpu = torch.cuda.get_device_name(device) if device.type == 'cuda' else 'cpu'
+    return '{}|{}|{}|{}|{}'.format(socket.gethostname(), os.cpu_count(), gpu, model_name, config.precision)
+
+
+def _load(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save(path, key, settings):
+    results = _load(path)
+    results[key] = settings
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # per process temporary file, folds of train_cv may save concurrently
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _memory(device):
+    # MB in use: this process plus the private pages of its workers, and the peak of the GPU
+    own = utils.process_memory(os.getpid())
+    host = (own['rss'] if own else 0) + sum(u['anon'] for u in utils.worker_memory().values())
+    gpu = torch.cuda.max_memory_allocated(device) / 1024 ** 2 if device.type == 'cuda' else 0
+    return host, gpu
+
+
+def profile(dataset, model, criterion, device, batch_size, num_workers, prefetch_factor, steps, warmup=5):
+    '''
+    Train a throwaway copy of model for warmup + steps batches.
+    :return: (samples per second, host MB, gpu MB), samples per second is 0 if the run failed (e.g. out of memory)
+    '''
+    model = copy.deepcopy(model).to(device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-6)
+    scaler = precision.grad_scaler(device)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+    loader = make_loader(dataset, device, batch_size=batch_size, shuffle=not isinstance(dataset, torch.utils.data.IterableDataset),
+                         drop_last=True, num_workers=num_workers, collate_fn=dataset.collate_fn,
+                         prefetch_factor=prefetch_factor)
+    samples, since, seconds, host, gpu = 0, None, None, 0., 0.
+
+    def elapsed():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.time() - since
+
+    try:
+        # batches may carry more fields after (inputs, target), e.g. the fold of MultiFoldECGDataset
+        for step, batch in enumerate(loader):
+            inputs, target = batch[0], batch[1]
+            if step == warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                since = time.time()
+            inputs, target = inputs.to(device), target.to(device).float()
+            optimizer.zero_grad()
+            with precision.autocast(device):
+                loss = criterion(model(inputs).float(), target)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            if since is not None:
+                samples += len(inputs)
+            if step == warmup + steps:
+                seconds = elapsed()
+                # measured while the workers are still alive
+                host, gpu = _memory(device)
+                break
+        if seconds is None and since is not None:
+            # the epoch ended before steps batches
+            seconds = elapsed()
+            host, gpu = _memory(device)  # workers that already exited are not counted
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        samples = 0
+    finally:
+        del loader
+    if seconds is None or samples == 0:
+        return 0., host, gpu
+    return samples / seconds, host, gpu
+
+
+def tune(dataset, model, criterion, device):
+    '''
+    Coordinate search: batch size at the default worker count, then workers, then prefetch factor.
+    :return: dict with batch_size, num_workers, prefetch_factor and the measured samples_per_s
+    '''
+    best = {'batch_size': config.batch_size, 'num_workers': min(config.num_workers, os.cpu_count()), 'prefetch_factor': 2,
+            'samples_per_s': 0.}
+    limit_host = config.autotune_memory_bytes / 1024 ** 2
+    limit_gpu = (torch.cuda.get_device_properties(device).total_memory * 0.9 / 1024 ** 2
+                 if device.type == 'cuda' else float('inf'))
+    workers = sorted(set(min(w, os.cpu_count()) for w in config.autotune_workers))
+    prefetch = config.autotune_prefetch if supports_prefetch_factor() else [2]
+    for knob, values in (('batch_size', config.autotune_batch_sizes), ('num_workers', workers),
+                         ('prefetch_factor', prefetch)):
+        for value in values:
+            trial = dict(best, **{knob: value})
+            if knob == 'prefetch_factor' and trial['num_workers'] == 0:
+                continue
+            speed, host, gpu = profile(dataset, model, criterion, device, trial['batch_size'], trial['num_workers'],
+                                       trial['prefetch_factor'], config.autotune_steps)
+            fits = host <= limit_host and gpu <= limit_gpu
+            print("autotune: batch_size={batch_size} num_workers={num_workers} prefetch_factor={prefetch_factor}"
+                  .format(**trial) + " -> {:.1f} samples/s, host {:.0f} MB, gpu {:.0f} MB{}"
+                  .format(speed, host, gpu, '' if fits else ' (over memory limit)'))
+            if fits and speed > best['samples_per_s']:
+                best = dict(trial, samples_per_s=speed)
+    return best
+
+
+def loader_settings(dataset, model, criterion, device):
+    '''
+    batch_size, num_workers, val_num_workers and prefetch_factor for train/train_cv:
+    the config values, or the tuned ones of this host when config.autotune is on
+    (tuned once, then read from config.autotune_file)
+    '''
+    settings = {'batch_size': config.batch_size, 'num_workers': config.num_workers,
+                'val_num_workers': config.val_num_workers, 'prefetch_factor': 2}
+    if not config.autotune:
+        return settings
+    key = _host_key(config.model_name, device)
+    tuned = _load(config.autotune_file).get(key)
+    if tuned is None:
+        tuned = tune(dataset, model, criterion, device)
+        _save(config.autotune_file, key, tuned)
+    settings.update(batch_size=tuned['batch_size'], num_workers=tuned['num_workers'],
+                    val_num_workers=tuned['num_workers'], prefetch_factor=tuned['prefetch_factor'])
+    print("autotune: {}".format(settings))
+    return settings
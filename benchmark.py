@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmarks of the data pipeline, reported as records per second.
+
+    python benchmark.py preprocess                  # synthetic records
+    python benchmark.py preprocess --data ../input_directory -n 2000
+    python benchmark.py matio --mat-format 5        # matio.load_val against loadmat
+    python benchmark.py stratify                    # fold splitting at 40k, 400k and 4M records
+    python benchmark.py metrics                     # scoring functions against the official scorer, 1k-100k records
+    python benchmark.py precision --fold ./pth/round1_data_0.pth --data ./cache/<store> --weights ckpt/.../best_weight_fold0.pth
+                                                    # fp32 against bf16 (and fp16 on CUDA): speed and challenge metric
+'''
+import os, time, shutil, tempfile
+import numpy as np
+import scipy.io as sio
+
+
+def best_time(fn, repeat=3):
+    # best wall time of repeat calls, in seconds
+    best = float('inf')
+    for _ in range(repeat):
+        since = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - since)
+    return best
+
+
+def report(stage, records, seconds):
+    print("%-28s %8d records %12.1f records/s" % (stage, records, records / seconds))
+
+
+def make_records(directory, n, rates=(500, 1000, 257), seconds=10, seed=0, mat_format='4'):
+    '''write n synthetic 12-lead challenge records (.mat + .hea) cycling through rates'''
+    rng = np.random.RandomState(seed)
+    for i in range(n):
+        fs = rates[i % len(rates)]
+        siglen = fs * seconds
+        name = 'S%05d' % i
+        sio.savemat(os.path.join(directory, name + '.mat'),
+                    {'val': (rng.randn(12, siglen) * 1000).astype(np.int16)}, format=mat_format)
+        with open(os.path.join(directory, name + '.hea'), 'w') as f:
+            f.write('%s 12 %d %d 05-Feb-2020 11:39:16\n' % (name, fs, siglen))
+            for lead in range(12):
+                f.write('%s.mat 16+24 1000/mV 16 0 0 0 0 L%d\n' % (name, lead))
+            f.write('#Age: 50\n#Sex: Male\n#Dx: 426783006\n#Rx: Unknown\n#Hx: Unknown\n#Sx: Unknown\n')
+
+
+def records(args):
+    # (directory, record paths without extension, temporary directory to remove or None)
+    if args.data:
+        directory, tmp = args.data, None
+    else:
+        directory = tmp = tempfile.mkdtemp(prefix='ecg_bench_')
+        make_records(directory, args.n, mat_format=args.mat_format)
+    names = sorted(f[:-4] for f in os.listdir(directory) if f.endswith('.mat'))[:args.n]
+    return directory, [os.path.join(directory, name) for name in names], tmp
+
+
+def bench_preprocess(args):
+    from header_index import read_header
+    from matio import load_val
+    from preprocess import Preprocessor
+
+    directory, files, tmp = records(args)
+    try:
+        preprocessor = Preprocessor()
+        n = len(files)
+        report('load_val', n, best_time(lambda: [load_val(f + '.mat') for f in files], args.repeat))
+        report('read_header', n, best_time(lambda: [read_header(f + '.hea') for f in files], args.repeat))
+
+        sigs = [load_val(f + '.mat') for f in files]
+        headers = [read_header(f + '.hea') for f in files]
+        fs = np.array([h['fs'] for h in headers])
+        gains = np.array([h['adc_gain'] for h in headers])
+
+        for rate in np.unique(fs):
+            group = [sig for sig, r in zip(sigs, fs) if r == rate]
+            report('resample %d Hz' % rate, len(group),
+                   best_time(lambda: [preprocessor.resample(sig, rate) for sig in group], args.repeat))
+
+        resampled = [preprocessor.resample(sig, r) for sig, r in zip(sigs, fs)]
+        out = np.empty((12, preprocessor.SIGLEN), dtype=np.float32)
+        def fit_gain():
+            for sig, gain in zip(resampled, gains):
+                preprocessor.fit(sig, out)
+                np.divide(out, gain, out=out)
+        report('pad/truncate + gain', n, best_time(fit_gain, args.repeat))
+
+        report('record API', n, best_time(
+            lambda: [preprocessor(sig, r, gain) for sig, r, gain in zip(sigs, fs, gains)], args.repeat))
+        report('batch API', n, best_time(lambda: preprocessor.batch(sigs, fs, gains), args.repeat))
+        report('load_batch (disk)', n, best_time(lambda: preprocessor.load_batch(files), args.repeat))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_matio(args):
+    from matio import load_val
+
+    directory, files, tmp = records(args)
+    try:
+        mats = [f + '.mat' for f in files]
+        for mat in mats:
+            a, b = load_val(mat), sio.loadmat(mat)['val']
+            assert a.dtype == b.dtype and np.array_equal(a, b), mat
+        loadmat_time = best_time(lambda: [sio.loadmat(mat)['val'] for mat in mats], args.repeat)
+        load_val_time = best_time(lambda: [load_val(mat) for mat in mats], args.repeat)
+        report('scipy.io.loadmat', len(mats), loadmat_time)
+        report('matio.load_val', len(mats), load_val_time)
+        print("identical output, {:.1f}x faster".format(loadmat_time / load_val_time))
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def synthetic_labels(n, num_classes=27, seed=0):
+    # 1-3 labels per record with long-tailed class frequencies, like the scored SNOMED classes
+    rng = np.random.RandomState(seed)
+    p = 1. / np.arange(1, num_classes + 1) ** 1.2
+    p /= p.sum()
+    y = np.zeros((n, num_classes), dtype=np.uint8)
+    for j in range(3):
+        keep = rng.rand(n) < (1., 0.3, 0.1)[j]
+        y[np.flatnonzero(keep), rng.choice(num_classes, keep.sum(), p=p)] = 1
+    return y
+
+
+def fold_quality(y, folds, kfold):
+    # label distribution: mean |share of a label's positives in a fold - 1/kfold|, and the fold size spread
+    counts = np.stack([y[folds == k].sum(axis=0) for k in range(kfold)]).astype(np.float64)
+    present = counts.sum(axis=0) > 0
+    ld = np.abs(counts[:, present] / counts[:, present].sum(axis=0) - 1. / kfold).mean()
+    sizes = np.bincount(folds, minlength=kfold)
+    return ld, sizes.max() - sizes.min()
+
+
+def sizes(args, default):
+    return [int(n) for n in (args.sizes or default).split(',')]
+
+
+def bench_stratify(args):
+    from stratify import iterative_stratification
+
+    kfold = 5
+    for n in sizes(args, '40000,400000,4000000'):
+        y = synthetic_labels(n)
+        since = time.perf_counter()
+        folds = iterative_stratification(y, kfold, seed=42)
+        seconds = time.perf_counter() - since
+        ld, spread = fold_quality(y, folds, kfold)
+        print("%-28s %8d records %8.2f s   label dist %.5f  size spread %d" % ('iterative_stratification', n, seconds, ld, spread))
+
+        groups = np.random.RandomState(1).randint(0, max(n // 3, 1), n)
+        since = time.perf_counter()
+        folds = iterative_stratification(y, kfold, groups=groups, seed=42)
+        seconds = time.perf_counter() - since
+        ld, spread = fold_quality(y, folds, kfold)
+        split_groups = np.unique(np.stack([groups, folds]), axis=1).shape[1] - len(np.unique(groups))
+        assert split_groups == 0, split_groups
+        print("%-28s %8d records %8.2f s   label dist %.5f  size spread %d" % ('  with groups (~3/group)', n, seconds, ld, spread))
+
+        if n <= args.reference_max:
+            try:
+                from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+            except ImportError:
+                continue
+            since = time.perf_counter()
+            folds = np.empty(n, dtype=np.int64)
+            mskf = MultilabelStratifiedKFold(n_splits=kfold, shuffle=True, random_state=42)
+            for k, (_, val) in enumerate(mskf.split(np.zeros(n), y)):
+                folds[val] = k
+            seconds = time.perf_counter() - since
+            ld, spread = fold_quality(y, folds, kfold)
+            print("%-28s %8d records %8.2f s   label dist %.5f  size spread %d" % ('iterstrat (reference)', n, seconds, ld, spread))
+
+
+def official_scorer():
+    # the unmodified challenge scorer in evaluation/, reference of the metrics benchmark
+    import importlib.util
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluation', 'evaluate_12ECG_score.py')
+    spec = importlib.util.spec_from_file_location('official_evaluate_12ECG_score', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def compute_beta_score_loops(labels, output, beta, num_classes, check_errors=True):
+    # utils.compute_beta_score before vectorization, reference of the metrics benchmark
+
+    # Check inputs for errors.
+    if check_errors:
+        if len(output) != len(labels):
+            raise Exception('Numbers of outputs and labels must be the same.')
+
+    # Populate contingency table.
+    num_recordings = len(labels)
+
+    fbeta_l = np.zeros(num_classes)
+    gbeta_l = np.zeros(num_classes)
+    fmeasure_l = np.zeros(num_classes)
+    accuracy_l = np.zeros(num_classes)
+
+    f_beta = 0
+    g_beta = 0
+    f_measure = 0
+    accuracy = 0
+
+    # Weight function
+    C_l=np.ones(num_classes);
+
+    for j in range(num_classes):
+        tp = 0
+        fp = 0
+        fn = 0
+        tn = 0
+
+        for i in range(num_recordings):
+            
+            num_labels = np.sum(labels[i])
+        
+            if labels[i][j] and output[i][j]:
+                tp += 1/num_labels
+            elif not labels[i][j] and output[i][j]:
+                fp += 1/num_labels
+            elif labels[i][j] and not output[i][j]:
+                fn += 1/num_labels
+            elif not labels[i][j] and not output[i][j]:
+                tn += 1/num_labels
+
+        # Summarize contingency table.
+        if ((1+beta**2)*tp + (fn*beta**2) + fp):
+            fbeta_l[j] = float((1+beta**2)* tp) / float(((1+beta**2)*tp) + (fn*beta**2) + fp)
+        else:
+            fbeta_l[j] = 1.0
+
+        if (tp + fp + beta * fn):
+            gbeta_l[j] = float(tp) / float(tp + fp + beta*fn)
+        else:
+            gbeta_l[j] = 1.0
+
+        if tp + fp + fn + tn:
+            accuracy_l[j] = float(tp + tn) / float(tp + fp + fn + tn)
+        else:
+            accuracy_l[j] = 1.0
+
+        if 2 * tp + fp + fn:
+            fmeasure_l[j] = float(2 * tp) / float(2 * tp + fp + fn)
+        else:
+            fmeasure_l[j] = 1.0
+
+
+    for i in range(num_classes):
+        f_beta += fbeta_l[i]*C_l[i]
+        g_beta += gbeta_l[i]*C_l[i]
+        f_measure += fmeasure_l[i]*C_l[i]
+        accuracy += accuracy_l[i]*C_l[i]
+
+
+    f_beta = float(f_beta)/float(num_classes)
+    g_beta = float(g_beta)/float(num_classes)
+    f_measure = float(f_measure)/float(num_classes)
+    accuracy = float(accuracy)/float(num_classes)
+
+
+    return accuracy,f_measure,f_beta,g_beta
+
+
+def bench_metrics(args):
+    import metrics
+    import utils
+
+    reference = official_scorer()
+    for n in sizes(args, '1000,10000,100000'):
+        labels = synthetic_labels(n).astype(bool)
+        # outputs: labels with 10% of the entries flipped
+        outputs = labels ^ (np.random.RandomState(1).rand(*labels.shape) < 0.1)
+        seconds = best_time(lambda: metrics.compute_modified_confusion_matrix(labels, outputs), args.repeat)
+        report('confusion matrix', n, seconds)
+        if n <= args.reference_max:
+            reference_seconds = best_time(lambda: reference.compute_modified_confusion_matrix(labels, outputs), 1)
+            report('  official (loops)', n, reference_seconds)
+            print("  %.0fx faster" % (reference_seconds / seconds))
+
+        seconds = best_time(lambda: utils.compute_beta_score(labels, outputs, 2, labels.shape[1]), args.repeat)
+        report('compute_beta_score', n, seconds)
+        if n <= args.reference_max:
+            reference_seconds = best_time(lambda: compute_beta_score_loops(labels, outputs, 2, labels.shape[1]), 1)
+            report('  loops', n, reference_seconds)
+            print("  %.0fx faster" % (reference_seconds / seconds))
+
+        # scores rounded to 3 decimals, so there are ties like in real model outputs
+        scores = np.round(np.clip(labels * 0.3 + np.random.RandomState(2).rand(*labels.shape) * 0.7, 0, 1), 3)
+        seconds = best_time(lambda: metrics.compute_auc(labels, scores), args.repeat)
+        report('AUROC/AUPRC', n, seconds)
+        if n <= args.reference_max:
+            reference_seconds = best_time(lambda: reference.compute_auc(labels, scores), 1)
+            assert metrics.compute_auc(labels, scores) == reference.compute_auc(labels, scores)
+            report('  official (loops)', n, reference_seconds)
+            print("  %.0fx faster" % (reference_seconds / seconds))
+
+
+def bench_precision(args):
+    import copy
+    import torch
+    from torch.utils.data import DataLoader
+    import models, utils, precision
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = getattr(models, args.model)()
+    if args.weights:
+        model.load_state_dict(torch.load(args.weights, map_location='cpu')['state_dict'])
+    model = model.to(device).eval()
+    if args.fold:
+        # validation records of a fold, labels from the fold file
+        from dataset import ECGDataset
+        batches = DataLoader(ECGDataset(args.fold, args.data, train=False), batch_size=args.batch_size)
+    else:
+        # random weights and inputs only measure the agreement with fp32, not a meaningful score
+        rng = np.random.RandomState(0)
+        x = torch.from_numpy(rng.randn(args.n, 12, 5000).astype(np.float32))
+        y = torch.from_numpy(synthetic_labels(args.n))
+        batches = [(x[i:i + args.batch_size], y[i:i + args.batch_size]) for i in range(0, args.n, args.batch_size)]
+
+    modes = []
+    for mode in precision.PRECISIONS:
+        try:
+            modes.append(precision.check(device, mode))
+        except ValueError as e:
+            print("skip %s: %s" % (mode, e))
+
+    reference = None
+    print("inference (%s, threshold %.2f)" % (device.type, args.threshold))
+    for mode in modes:
+        def run():
+            probs, labels = [], []
+            with torch.no_grad(), precision.autocast(device, mode):
+                for inputs, target in batches:
+                    probs.append(torch.sigmoid(model(inputs.to(device)).float()).cpu())
+                    labels.append(target.float())
+            return torch.cat(probs), torch.cat(labels)
+        probs, labels = run()
+        seconds = best_time(run, args.repeat)
+        acc, f1, f2, g2, cm = utils.calc_metric(labels, probs, args.threshold)
+        if reference is None:
+            reference = probs
+        diff = (probs - reference).abs().max().item()
+        flipped = ((probs > args.threshold) != (reference > args.threshold)).float().mean().item()
+        print("%-6s %8.1f records/s   challenge %.4f  f2 %.4f  g2 %.4f   max |p - p_fp32| %.2e  flipped labels %.3f%%"
+              % (mode, len(probs) / seconds, cm, f2, g2, diff, flipped * 100))
+
+    print("training steps (batch %d)" % args.batch_size)
+    inputs, target = [t.to(device) for t in batches[0]] if isinstance(batches, list) else \
+        [t.to(device) for t in next(iter(batches))]
+    target = target.float()
+    criterion = utils.WeightedMultilabel(torch.ones(target.shape[1], device=device))
+    for mode in modes:
+        net = copy.deepcopy(model).train()
+        optimizer = torch.optim.SGD(net.parameters(), lr=1e-6)
+        scaler = precision.grad_scaler(device, mode)
+        def step():
+            optimizer.zero_grad()
+            with precision.autocast(device, mode):
+                loss = criterion(net(inputs).float(), target)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+        step()
+        report('  ' + mode, len(inputs), best_time(step, args.repeat))
+
+
+BENCHMARKS = {
+    'preprocess': bench_preprocess,
+    'matio': bench_matio,
+    'stratify': bench_stratify,
+    'metrics': bench_metrics,
+    'precision': bench_precision,
+}
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", metavar="<command>", choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument("--data", type=str, help="challenge data directory, synthetic records if omitted")
+    parser.add_argument("-n", type=int, default=600, help="number of records")
+    parser.add_argument("--mat-format", type=str, default='4', choices=['4', '5'], help="MAT version of synthetic records")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sizes", type=str, help="record counts of the stratify (default 40000,400000,4000000) "
+                                                  "and metrics (default 1000,10000,100000) benchmarks")
+    parser.add_argument("--reference-max", type=int, default=40000,
+                        help="largest size also run through the reference (iterstrat, official scorer)")
+    parser.add_argument("--model", type=str, default='iresnest50_predict', help="models.<name> of the precision benchmark")
+    parser.add_argument("--weights", type=str, help="checkpoint of the precision benchmark, random weights if omitted")
+    parser.add_argument("--fold", type=str, help="fold file whose val records the precision benchmark scores (with --data)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    args = parser.parse_args()
+    BENCHMARKS[args.command](args)
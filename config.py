@@ -24,6 +24,8 @@ class Config:
 
     train_data = os.path.join(r"./pth", 'round1_data_0.pth')
     train_data_cv = os.path.join(r"./pth", 'round1_data_{}.pth')
+    #划分fold的记录(记录集合和标签的指纹, 每条记录所属的fold), 数据不变时直接复用, 新增记录增量分配
+    split_meta = os.path.join(r"./pth", 'split_meta.pth')
 
     train_aug_data = os.path.join(root, 'train_round2_aug.pth')
     train_all_data = os.path.join(root, 'train_round2_all.pth')
@@ -45,6 +47,21 @@ class Config:
     stage_epoch = [32,64,80]#[24,48,72,84] #[32,64,80]#
     #训练时的batch大小
     batch_size = 16 #32#
+    #训练/验证DataLoader的worker数
+    num_workers = 6
+    val_num_workers = 4
+    #自动调优: 在本机上短时间试跑不同的batch_size/worker数/prefetch_factor, 取内存限制内样本吞吐最高的组合, 按主机保存在autotune_file中复用
+    autotune = False
+    autotune_file = './cache/autotune.json'
+    autotune_batch_sizes = [16, 32, 64]
+    autotune_workers = [0, 2, 4, 6, 8, 12, 16]
+    autotune_prefetch = [2, 4, 8]
+    #每组配置计时的训练步数(另有5步预热), 步数太少时计时噪声会影响worker数和prefetch_factor的排序
+    autotune_steps = 200
+    #主进程加所有worker的内存上限(字节)
+    autotune_memory_bytes = 32 * 1024 ** 3
+    #训练/验证/推理的计算精度(precision.py): 'fp32', 'bf16'(CPU或GPU, torch>=1.10) 或 'fp16'(GPU, 带loss scaling)
+    precision = 'fp32'
     #label的类别数
     num_classes = 27
     #最大训练多少个epoch
@@ -54,6 +71,44 @@ class Config:
 
     target_fs = 500
 
+    #预处理(transform_sig)使用的进程数, None表示使用全部cpu核
+    preprocess_workers = None
+    #预处理结果的缓存目录, 训练结束后不再删除, 下次训练直接复用
+    cache_dir = './cache'
+    #缓存目录的大小上限(字节), 超出后按最近最少使用淘汰, None表示不限制
+    cache_max_bytes = 64 * 1024 ** 3
+    #训练时把预处理数据一次性读入共享内存, 所有DataLoader worker和所有fold共用
+    ram_cache = False
+    #共享内存缓存的上限(字节), 放不下的样本仍从磁盘读取
+    ram_cache_bytes = 32 * 1024 ** 3
+    #数据增强在collate阶段按batch进行(dataset.AugmentCollate), False则在__getitem__中逐样本进行
+    batch_augment = True
+
+    #推理时把超过10s的记录切成多个10s窗口分别预测再汇总, False则只用前10s
+    infer_window = False
+    #相邻窗口起点的间隔(采样点), 小于target_point_num时窗口重叠
+    infer_stride = 500 * 5
+    #每条记录最多使用的窗口数, 超出时在整条记录上均匀抽取, None表示全部使用
+    infer_max_windows = 32
+    #窗口概率的汇总方式: 'max' 或 'mean'
+    infer_pool = 'max'
+    #一次送入模型的窗口数, 限制长记录推理时的显存/内存
+    infer_batch_size = 32
+
+    #DataLoader使用锁页内存和常驻worker, 并由后台线程预取下一个batch(GPU上用独立stream异步拷贝), 见loader.py; False则为普通DataLoader
+    fast_loader = False
+    #预取的batch数
+    loader_prefetch = 2
+    #训练时每show_interval个batch打印一次各DataLoader worker的常驻内存(RSS/匿名页), 用于排查写时复制导致的内存增长
+    report_worker_memory = False
+
+    #训练数据从顺序读取的大分片文件(shards.py)流式读取, 适合内存放不下且在网络文件系统上的数据集
+    shards = False
+    #每个分片包含的记录数
+    shard_records = 1024
+    #分片模式下的shuffle缓冲区大小(样本数)
+    shuffle_buffer = 2048
+
     #保存模型的文件夹
     ckpt = 'ckpt'
     #保存提交文件的文件夹
@@ -72,6 +127,18 @@ class Config:
     current_w_cv = 'current_weight_fold{}.pth'
     #保存最佳的权重
     best_w_cv = 'best_weight_fold{}.pth'
+    #保存fold的完整训练状态(权重, optimizer, lr scheduler, 早停计数), 用于断点续训
+    resume_w_cv = 'resume_fold{}.pth'
+    #继续之前的train_cv: 填入其模型保存目录(如 ckpt/iresnest50_pretrain_cv_202010011200), 已完成的fold跳过, 未完成的从最近的epoch继续; None时新建模型保存目录, 不读取任何resume文件
+    resume_dir = None
+    #train_cv同时训练的fold数, 每个fold一个进程, 平分可用的cpu核; 1表示依次训练
+    fold_workers = 1
+    #每个fold进程的intra-op线程数, None表示分给它的cpu核数
+    fold_threads = None
+    #fold进程异常退出后从resume文件重新开始的次数
+    fold_retries = 2
+    #train_cv在一个进程中同时训练所有fold的模型, 每个batch只读取和增强一次, 按样本所属fold分配给各模型; 验证也只需一遍
+    cv_single_pass = False
     #for test
     temp_dir=os.path.join(root,'temp')
 
@@ -11,11 +11,15 @@ import numpy as np
 import pandas as pd
 from config import config
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from sklearn.preprocessing import scale
 from scipy import signal
 from scipy import signal as sig
 from scipy.signal import medfilt
 import scipy.io as sio
+from store import SignalStore, is_store
+from preprocess import Preprocessor
+from split import load_fold
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -46,26 +50,11 @@ warnings.filterwarnings('ignore')
 #         #data_recon = butterworth_notch(data_recon, cut_off = [49, 51], order = 2, sampling_freq = fs)
 #     return df_data
 
-def butterworth_high_pass(x, cut_off, order, sampling_freq):
-    #
-    nyq_freq = sampling_freq / 2
-    digital_cutoff = cut_off / nyq_freq
-    #
-    b, a = sig.butter(order, digital_cutoff, btype='highpass')
-    y = sig.lfilter(b, a, x, axis = -1)
-
-    return y
-
-def butterworth_notch(x, cut_off, order, sampling_freq):
-    #
-    cut_off = np.array(cut_off)
-    nyq_freq = sampling_freq / 2
-    digital_cutoff = cut_off / nyq_freq
-    #
-    b, a = sig.butter(order, digital_cutoff, btype='bandstop')
-    y = sig.lfilter(b, a, x, axis = -1)
-    #
-    return y
+def butterworth_high_pass(x, cut_off, order, sampling_freq, out=None):
+    return high_pass_filter(x, cut_off, order, sampling_freq, axis=-1, out=out)
+
+def butterworth_notch(x, cut_off, order, sampling_freq, out=None):
+    return notch_filter(x, cut_off, order, sampling_freq, axis=-1, out=out)
 
 # def wavelet_db4(df_data, wavefunc="db4", lv=4, m=2, n=4):  #
 
@@ -104,33 +93,14 @@ def butterworth_notch(x, cut_off, order, sampling_freq):
 #     return ecg_sig
 
 from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt, lfilter, lfilter_zi, filtfilt, sosfreqz, resample
-def butter_bandpass(lowcut, highcut, fs, order=5):
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-    sos = butter(order, [low, high], analog=False, btype="band", output="sos")
-    return sos
-
-
-def butter_bandpass_filter(df_data, lowcut, highcut, fs, order=5):
-    sos = butter_bandpass(lowcut, highcut, fs, order=order)
-    ecg_sig = np.zeros([df_data.shape[0],df_data.shape[1]])
-    for i in range(df_data.shape[1]):
-        data = df_data[:,i]
-        y = sosfilt(sos,
-                    data)  # Filter data along one dimension using cascaded second-order sections. Using lfilter for each second-order section.
-        ecg_sig[:,i] = y
-    return ecg_sig
-
-def butter_bandpass_forward_backward_filter(df_data, lowcut, highcut, fs, order=5):
-    sos = butter_bandpass(lowcut, highcut, fs, order=order)
-    ecg_sig = np.zeros([df_data.shape[0],df_data.shape[1]])
-    for i in range(df_data.shape[1]):
-        data = df_data[:,i]
-        y = sosfiltfilt(sos,
-                        data)  # Apply a digital filter forward and backward to a signal.This function applies a linear digital filter twice, once forward and once backwards. The combined filter has zero phase and a filter order twice that of the original.
-        ecg_sig[:,i] = y
-    return ecg_sig
+from filters import butter_bandpass, bandpass_filter, bandpass_forward_backward_filter, high_pass_filter, notch_filter
+
+# df_data is (T, 12): all leads are filtered along axis 0 in one call with a cached design
+def butter_bandpass_filter(df_data, lowcut, highcut, fs, order=5, out=None):
+    return bandpass_filter(df_data, lowcut, highcut, fs, order=order, axis=0, out=out)
+
+def butter_bandpass_forward_backward_filter(df_data, lowcut, highcut, fs, order=5, out=None):
+    return bandpass_forward_backward_filter(df_data, lowcut, highcut, fs, order=order, axis=0, out=out)
 
 def scaling(X, sigma=0.05):
     scalingFactor = np.random.normal(loc=1.0, scale=sigma, size=(1, X.shape[1]))
@@ -151,10 +121,9 @@ def shift(sig, interval=20):
     :param sig:
     :return:
     '''
-    for col in range(sig.shape[1]):
-        offset = np.random.choice(range(-interval, interval))/100
-        sig[:, col] += offset
-    return sig
+    # not in place: sig may be a read-only view into the signal store
+    offset = np.random.randint(-interval, interval, size=sig.shape[1])/100
+    return sig + offset
 
 #https://www.physionet.org/content/nstdb/1.0.0/
 def transform(sig, train=True):
@@ -198,6 +167,49 @@ def transform(sig, train=True):
     sig = torch.tensor(sig.copy(), dtype=torch.float)
     return sig
 
+class BatchAugment(object):
+    '''
+    transform(train=True) applied to a whole (B, 12, T) batch at once.
+    Every augmentation keeps its probability, drawn per sample, and is applied through a mask.
+    '''
+    def __init__(self, sigma=0.05, interval=20, lowcut=0.05, highcut=46, fs=256, order=5):
+        self.sigma = sigma
+        self.interval = interval
+        self.band = (lowcut, highcut, fs, order)
+
+    def __call__(self, x):
+        B, C, _ = x.shape
+        p = torch.randn(B, 4)
+
+        # scaling: per lead gain ~ N(1, sigma)
+        scale = torch.where((p[:, 0] > 0.5)[:, None], 1 + self.sigma * torch.randn(B, C), torch.ones(B, C))
+        x = x * scale[:, :, None]
+
+        # verflip: reverse in time
+        m = p[:, 1] > 0.3
+        if m.any():
+            x[m] = x[m].flip(-1)
+
+        # shift: per lead offset in [-interval, interval)/100
+        offset = torch.randint(-self.interval, self.interval, (B, C)).float() / 100
+        x = x + torch.where((p[:, 2] > 0.5)[:, None], offset, torch.zeros(B, C))[:, :, None]
+
+        # band pass along time for all selected samples and leads in one call
+        m = p[:, 3] > 0.3
+        if m.any():
+            x[m] = torch.from_numpy(bandpass_filter(x[m].numpy(), *self.band, axis=-1).astype(np.float32))
+        return x
+
+
+class AugmentCollate(object):
+    '''collate_fn that stacks the batch and then runs BatchAugment on the inputs (the first field)'''
+    def __init__(self, augment=None):
+        self.augment = BatchAugment() if augment is None else augment
+
+    def __call__(self, batch):
+        inputs, *fields = default_collate(batch)
+        return (self.augment(inputs),) + tuple(fields)
+
 def transform_beat(sig, train=False):
     # 前置不可或缺的步骤
     # sig = resample(sig, config.target_point_num)
@@ -219,116 +231,87 @@ import scipy.io as scio
 class ECGDataset(Dataset):
     """
     A generic data loader where the samples are arranged in this way:
-    dd = {'train': train, 'val': val, "idx2name": idx2name, 'file2idx': file2idx}
+    dd = {'train': train rows, 'val': val rows, "idx2name": idx2name, 'names': names, 'labels': packed labels}
+    (see split.load_fold), the target is a zero-copy uint8 row of the label matrix
+    data_dir is a SignalStore directory written by train_12ECG_classifier.transform_sig,
+    or a raw challenge directory whose records are run through preprocess.Preprocessor on access
+    cache is an optional store.SharedSignalCache over the same store, shared between datasets and workers
+    batch_augment moves the training augmentation out of __getitem__ into collate_fn (AugmentCollate)
+    every per-sample structure (rows, names, labels, store rows) is a numpy array, so forked DataLoader
+    workers do not touch refcounts of shared Python objects and their pages stay shared
     """
-    def __init__(self, data_path, data_dir,train=True):
+    def __init__(self, data_path, data_dir,train=True,cache=None,batch_augment=False):
         super(ECGDataset, self).__init__()
-        dd = torch.load(data_path) #config.train_data
+        dd = load_fold(data_path) #config.train_data
         self.train = train
         self.data = dd['train'] if train else dd['val']
         self.idx2name = dd['idx2name']
-        self.file2idx = dd['file2idx']
+        self.names = dd['names']
+        self.labels = dd['labels']
         self.wc = 1. / np.log(dd['wc'])
         self.FS = 500
         self.SIGLEN = 500 * 10
         self.train_dir = data_dir#config.train_dir
         self.test_dir = data_dir#config.test_dir
+        self.store = SignalStore(data_dir) if is_store(data_dir) else None
+        # store row of every sample, resolved once here instead of per __getitem__
+        self.store_rows = self.store.rows(self.names[self.data]) if self.store is not None else None
+        self.preprocessor = Preprocessor(self.FS, self.SIGLEN)
+        self.cache = cache
+        self.batch_augment = batch_augment and train
+        self.collate_fn = AugmentCollate() if self.batch_augment else default_collate
 
     def __getitem__(self, index):
-        # fid = self.data[index]
-        fid = self.data[index]
-        # print(fid)
-
-        #method one
-
-        # file = fid.split('/')[-1].split('.')[0]
-        # if self.train:
-        #     file_path = os.path.join(self.train_dir, file)
-        # else:
-        #     file_path = os.path.join(self.test_dir, file)
-
-        # sig = sio.loadmat(file_path+'.mat')["val"]#(12,5000)
-        # with open(file_path+'.hea','r') as f:
-        #     header_data=f.readlines()
-
-        # fs = int(header_data[0].split(' ')[2])
-        # siglen = int(header_data[0].split(' ')[3])
-        # adc_gain = int(header_data[1].split(' ')[2].split('/')[0])
-
-        # if fs == self.FS * 2 :
-        #     sig = sig[:,::2]
-        # elif fs == self.FS:
-        #     pass
-        # elif fs != self.FS:
-        #     sig = signal.resample(sig.T, int(siglen/fs * self.FS)).T
-
-        # siglen = sig.shape[1]
-
-        # if siglen !=  self.SIGLEN:
-        #     sig_ext = np.zeros([12,self.SIGLEN])
-
-        # if siglen <  self.SIGLEN:
-        #     sig_ext[:,:siglen] = sig
-        # if siglen >  self.SIGLEN:
-        #     sig_ext = sig[:,:self.SIGLEN]
-
-        # if siglen !=  self.SIGLEN:
-        #     sig = sig_ext
-
-        # sig = sig/adc_gain
-
-        #method two
-
-        # annotation = wfdb.rdheader(file_path)
-        # record = wfdb.rdrecord(file_path)
-        # sig  = record.p_signal
-
-        # if annotation.fs == self.FS * 2 :
-        #     sig = sig[::2,:]
-        # elif annotation.fs == self.FS:
-        #     pass
-        # elif annotation.fs != self.FS:
-        #     siglen = annotation.fs*10
-        #     sig = sig[:siglen,:]
-        #     sig = signal.resample(sig, int(siglen/annotation.fs * FS))
-
-        # siglen = sig.shape[0]
-
-        # if siglen !=  self.SIGLEN:
-        #     sig_ext = np.zeros([self.SIGLEN,12])
-
-        # if siglen <  self.SIGLEN:
-        #     sig_ext[:siglen,:] = sig
-        # if siglen >  self.SIGLEN:
-        #     sig_ext = sig[:self.SIGLEN,:]
-
-        # if siglen !=  self.SIGLEN:
-        #     sig = sig_ext
-
-        #method three
-
-        file = fid.split('/')[-1]
-        if self.train:
-            file_path = os.path.join(self.train_dir, file)
-            #df = scio.loadmat(file_path)["val"].T/1000
-            sig = scio.loadmat(file_path)["val"]#.T
+        row = self.data[index]
+
+        if self.store is None:
+            # raw challenge directory: preprocess on the fly with the same pipeline as the store
+            sig = self.preprocessor.load(os.path.join(self.train_dir, str(self.names[row])))
+        elif self.cache is None:
+            # zero-copy (12, SIGLEN) view into the preprocessed memmap store
+            sig = self.store.signals[self.store_rows[index]]
         else:
-            file_path = os.path.join(self.test_dir, file)
-            # df = scio.loadmat(file_path)["val"].T/1000
-            sig = scio.loadmat(file_path)["val"]#.T
+            sig = self.cache.read(self.store_rows[index])
 
         #print(df.shape)
-        x = transform(sig.T, self.train)
+        if self.batch_augment:
+            x = torch.tensor(sig, dtype=torch.float)
+        else:
+            x = transform(sig.T, self.train)
 
-        target = np.zeros(config.num_classes)
-        target[self.file2idx[fid]] = 1
-        target = torch.tensor(target, dtype=torch.float32)
+        target = torch.from_numpy(self.labels[row])
         return x, target #beat,
 
     def __len__(self):
         return len(self.data)
 
 
+class MultiFoldECGDataset(ECGDataset):
+    """
+    Every record of the fold files data_paths (the k folds of one split, see split.train_cv_data),
+    for training all fold models in one pass: samples are (x, target, fold) with fold the record's
+    val fold, so fold model k trains on the samples with fold != k and validates on those with fold == k.
+    fold_wc[k] are the class weights of fold k.
+    """
+    def __init__(self, data_paths, data_dir, train=True, cache=None, batch_augment=False):
+        super(MultiFoldECGDataset, self).__init__(data_paths[0], data_dir, train=train, cache=cache,
+                                                  batch_augment=batch_augment)
+        folds = np.full(len(self.names), -1, dtype=np.int64)
+        self.fold_wc = []
+        for fold, data_path in enumerate(data_paths):
+            dd = torch.load(data_path)
+            assert np.array_equal(dd['names'], self.names), "{} is not a fold of the same split".format(data_path)
+            folds[dd['val']] = fold
+            self.fold_wc.append(1. / np.log(dd['wc']))
+        self.data = np.flatnonzero(folds >= 0)
+        self.folds = folds[self.data]
+        self.store_rows = self.store.rows(self.names[self.data]) if self.store is not None else None
+
+    def __getitem__(self, index):
+        x, target = super(MultiFoldECGDataset, self).__getitem__(index)
+        return x, target, self.folds[index]
+
+
 if __name__ == '__main__':
-    d = ECGDataset(config.train_data)
+    d = ECGDataset(config.train_data, config.train_dir)
     print(d[0])
@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 
 import numpy as np, os, sys
-from scipy.io import loadmat
+from matio import load_val
 from run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier
 
 def load_challenge_data(filename):
 
-    x = loadmat(filename)
-    data = np.asarray(x['val'], dtype=np.float64)
+    data = np.asarray(load_val(filename), dtype=np.float64)
 
     new_file = filename.replace('.mat','.hea')
     input_header_file = os.path.join(new_file)
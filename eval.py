@@ -1,4 +1,5 @@
 import numpy as np, os, os.path, sys
+from metrics import compute_auc, compute_modified_confusion_matrix
 
 def evaluate_12ECG_score(label_directory, output_directory):
     # Define the weights, the SNOMED CT code for the normal class, and equivalent SNOMED CT codes.
@@ -404,106 +405,6 @@ def compute_beta_measures(labels, outputs, beta):
 
     return macro_f_beta_measure, macro_g_beta_measure
 
-# Compute macro AUROC and macro AUPRC.
-def compute_auc(labels, outputs):
-    num_recordings, num_classes = np.shape(labels)
-
-    # Compute and summarize the confusion matrices for each class across at distinct output values.
-    auroc = np.zeros(num_classes)
-    auprc = np.zeros(num_classes)
-
-    for k in range(num_classes):
-        # We only need to compute TPs, FPs, FNs, and TNs at distinct output values.
-        thresholds = np.unique(outputs[:, k])
-        thresholds = np.append(thresholds, thresholds[-1]+1)
-        thresholds = thresholds[::-1]
-        num_thresholds = len(thresholds)
-
-        # Initialize the TPs, FPs, FNs, and TNs.
-        tp = np.zeros(num_thresholds)
-        fp = np.zeros(num_thresholds)
-        fn = np.zeros(num_thresholds)
-        tn = np.zeros(num_thresholds)
-        fn[0] = np.sum(labels[:, k]==1)
-        tn[0] = np.sum(labels[:, k]==0)
-
-        # Find the indices that result in sorted output values.
-        idx = np.argsort(outputs[:, k])[::-1]
-
-        # Compute the TPs, FPs, FNs, and TNs for class k across thresholds.
-        i = 0
-        for j in range(1, num_thresholds):
-            # Initialize TPs, FPs, FNs, and TNs using values at previous threshold.
-            tp[j] = tp[j-1]
-            fp[j] = fp[j-1]
-            fn[j] = fn[j-1]
-            tn[j] = tn[j-1]
-
-            # Update the TPs, FPs, FNs, and TNs at i-th output value.
-            while i < num_recordings and outputs[idx[i], k] >= thresholds[j]:
-                if labels[idx[i], k]:
-                    tp[j] += 1
-                    fn[j] -= 1
-                else:
-                    fp[j] += 1
-                    tn[j] -= 1
-                i += 1
-
-        # Summarize the TPs, FPs, FNs, and TNs for class k.
-        tpr = np.zeros(num_thresholds)
-        tnr = np.zeros(num_thresholds)
-        ppv = np.zeros(num_thresholds)
-        npv = np.zeros(num_thresholds)
-
-        for j in range(num_thresholds):
-            if tp[j] + fn[j]:
-                tpr[j] = float(tp[j]) / float(tp[j] + fn[j])
-            else:
-                tpr[j] = float('nan')
-            if fp[j] + tn[j]:
-                tnr[j] = float(tn[j]) / float(fp[j] + tn[j])
-            else:
-                tnr[j] = float('nan')
-            if tp[j] + fp[j]:
-                ppv[j] = float(tp[j]) / float(tp[j] + fp[j])
-            else:
-                ppv[j] = float('nan')
-
-        # Compute AUROC as the area under a piecewise linear function with TPR/
-        # sensitivity (x-axis) and TNR/specificity (y-axis) and AUPRC as the area
-        # under a piecewise constant with TPR/recall (x-axis) and PPV/precision
-        # (y-axis) for class k.
-        for j in range(num_thresholds-1):
-            auroc[k] += 0.5 * (tpr[j+1] - tpr[j]) * (tnr[j+1] + tnr[j])
-            auprc[k] += (tpr[j+1] - tpr[j]) * ppv[j+1]
-
-    # Compute macro AUROC and macro AUPRC across classes.
-    macro_auroc = np.nanmean(auroc)
-    macro_auprc = np.nanmean(auprc)
-
-    return macro_auroc, macro_auprc
-
-# Compute modified confusion matrix for multi-class, multi-label tasks.
-def compute_modified_confusion_matrix(labels, outputs):
-    # Compute a binary multi-class, multi-label confusion matrix, where the rows
-    # are the labels and the columns are the outputs.
-    num_recordings, num_classes = np.shape(labels)
-    A = np.zeros((num_classes, num_classes))
-
-    # Iterate over all of the recordings.
-    for i in range(num_recordings):
-        # Calculate the number of positive labels and/or outputs.
-        normalization = float(max(np.sum(np.any((labels[i, :], outputs[i, :]), axis=0)), 1))
-        # Iterate over all of the classes.
-        for j in range(num_classes):
-            # Assign full and/or partial credit for each positive class.
-            if labels[i, j]:
-                for k in range(num_classes):
-                    if outputs[i, k]:
-                        A[j, k] += 1.0/normalization
-
-    return A
-
 # Compute the evaluation metric for the Challenge.
 def compute_challenge_metric(weights, labels, outputs, classes, normal_class):
     num_recordings, num_classes = np.shape(labels)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''
+Butterworth filters for multi-lead signals.
+
+Filter designs are memoized on (band, order, fs), and every filter runs over
+all leads along one axis in a single scipy call. Pass out= to have the
+result copied into a buffer of the caller (e.g. a row of the signal store);
+scipy still allocates the filtered array, out= only saves the caller's own
+allocation and copy.
+'''
+from functools import lru_cache
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfiltfilt, lfilter
+
+
+@lru_cache(maxsize=64)
+def design_sos(band, order, fs, btype):
+    '''
+    :param band: cut-off frequency in Hz, or (low, high) tuple for band filters
+    :return: second-order sections, shared between callers and must not be modified
+    '''
+    nyq = 0.5 * fs
+    return butter(order, np.asarray(band) / nyq, analog=False, btype=btype, output="sos")
+
+
+@lru_cache(maxsize=64)
+def design_ba(band, order, fs, btype):
+    nyq = 0.5 * fs
+    return butter(order, np.asarray(band) / nyq, btype=btype)
+
+
+def _store(y, out):
+    # scipy has no out= argument, so y is always a new array
+    if out is None:
+        return y
+    out[...] = y
+    return out
+
+
+def butter_bandpass(lowcut, highcut, fs, order=5):
+    return design_sos((lowcut, highcut), order, fs, "band")
+
+
+def bandpass_filter(x, lowcut, highcut, fs, order=5, axis=-1, out=None):
+    # causal band pass of every lead of x along axis
+    return _store(sosfilt(butter_bandpass(lowcut, highcut, fs, order), x, axis=axis), out)
+
+
+def bandpass_forward_backward_filter(x, lowcut, highcut, fs, order=5, axis=-1, out=None):
+    # zero phase band pass of every lead of x along axis
+    return _store(sosfiltfilt(butter_bandpass(lowcut, highcut, fs, order), x, axis=axis), out)
+
+
+def high_pass_filter(x, cut_off, order, fs, axis=-1, out=None):
+    b, a = design_ba(cut_off, order, fs, "highpass")
+    return _store(lfilter(b, a, x, axis=axis), out)
+
+
+def notch_filter(x, cut_off, order, fs, axis=-1, out=None):
+    b, a = design_ba(tuple(cut_off), order, fs, "bandstop")
+    return _store(lfilter(b, a, x, axis=axis), out)
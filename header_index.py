@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+Columnar index of the WFDB headers (.hea) of a recording directory.
+
+The headers are scanned once with os.scandir, parsed in parallel and saved as
+an npz with one array per field. Later loads only parse the headers that were
+added or modified since the index was written.
+'''
+import os, hashlib
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+COLUMNS = ('names', 'mtimes', 'fs', 'sig_len', 'num_leads', 'adc_gain', 'age', 'sex', 'dx')
+
+
+def parse_header(header_data):
+    '''
+    :param header_data: lines of a .hea file
+    :return: dict with fs, sig_len, num_leads, adc_gain (of the first lead), age, sex and dx
+    '''
+    record = header_data[0].split(' ')
+    header = {'num_leads': int(record[1]), 'fs': int(record[2]), 'sig_len': int(record[3]),
+              'adc_gain': float(header_data[1].split(' ')[2].split('/')[0]),
+              'age': np.nan, 'sex': '', 'dx': ''}
+    for l in header_data:
+        if not l.startswith('#'):
+            continue
+        key, _, value = l[1:].partition(':')
+        value = value.strip()
+        if key == 'Age':
+            try:
+                header['age'] = float(value)
+            except ValueError:
+                pass
+        elif key == 'Sex':
+            header['sex'] = value
+        elif key == 'Dx':
+            header['dx'] = ','.join(dx.strip() for dx in value.split(','))
+    return header
+
+
+def read_header(header_file):
+    with open(header_file, 'r') as f:
+        return parse_header(f.readlines())
+
+
+def _read_headers(header_files):
+    return [read_header(f) for f in header_files]
+
+
+class HeaderIndex(object):
+    """
+    Headers of one directory, one numpy array per column, rows sorted by record name.
+    index[name] returns the header of one record as a dict.
+    """
+    def __init__(self, directory, columns):
+        self.directory = directory
+        for column in COLUMNS:
+            setattr(self, column, columns[column])
+        self.name2row = {name: row for row, name in enumerate(self.names.tolist())}
+
+    def __getitem__(self, name):
+        row = self.name2row[name]
+        return {column: getattr(self, column)[row] for column in COLUMNS[2:]}
+
+    def __contains__(self, name):
+        return name in self.name2row
+
+    def __len__(self):
+        return len(self.names)
+
+    def paths(self):
+        # record paths without extension, as used by split and transform_sig
+        return [self.directory + "/" + name for name in self.names.tolist()]
+
+    def to_frame(self):
+        return pd.DataFrame({column: getattr(self, column) for column in COLUMNS})
+
+
+def _index_file(directory, cache_dir):
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'headers_{}.npz'.format(key))
+
+
+def load_header_index(directory, cache_dir=None, workers=None):
+    '''
+    Load the header index of directory, parsing only new or modified headers.
+    Records without a matching .mat are left out.
+    :param cache_dir: where the index is kept, None to parse every header and keep nothing
+    :param workers: processes used to parse headers, None for os.cpu_count()
+    :return: HeaderIndex
+    '''
+    mats = set()
+    mtimes = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.hea' and not name.startswith('.'):
+                mtimes[name] = entry.stat().st_mtime_ns
+            elif ext == '.mat':
+                mats.add(name)
+    names = sorted(name for name in mtimes if name in mats)
+
+    index_file = _index_file(directory, cache_dir) if cache_dir else None
+    previous = {}
+    if index_file and os.path.isfile(index_file):
+        with np.load(index_file) as f:
+            old = {column: f[column] for column in COLUMNS}
+        old_rows = {name: row for row, name in enumerate(old['names'].tolist())}
+        for name in names:
+            row = old_rows.get(name)
+            if row is not None and old['mtimes'][row] == mtimes[name]:
+                previous[name] = {column: old[column][row] for column in COLUMNS[2:]}
+        unchanged = len(previous) == len(names) == len(old_rows)
+    else:
+        unchanged = False
+
+    todo = [name for name in names if name not in previous]
+    header_files = [os.path.join(directory, name + '.hea') for name in todo]
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(header_files) > 1000:
+        chunk = (len(header_files) + workers - 1) // workers
+        with Pool(workers) as pool:
+            parsed = pool.map(_read_headers, [header_files[i:i + chunk] for i in range(0, len(header_files), chunk)])
+        parsed = [h for part in parsed for h in part]
+    else:
+        parsed = _read_headers(header_files)
+    previous.update(zip(todo, parsed))
+
+    columns = {'names': np.array(names, dtype=str),
+               'mtimes': np.array([mtimes[name] for name in names], dtype=np.int64),
+               'fs': np.array([previous[name]['fs'] for name in names], dtype=np.int32),
+               'sig_len': np.array([previous[name]['sig_len'] for name in names], dtype=np.int32),
+               'num_leads': np.array([previous[name]['num_leads'] for name in names], dtype=np.int16),
+               'adc_gain': np.array([previous[name]['adc_gain'] for name in names], dtype=np.float32),
+               'age': np.array([previous[name]['age'] for name in names], dtype=np.float32),
+               'sex': np.array([previous[name]['sex'] for name in names], dtype=str),
+               'dx': np.array([previous[name]['dx'] for name in names], dtype=str)}
+
+    if index_file and not unchanged:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        print("header index: {} records, {} parsed".format(len(names), len(todo)))
+        np.savez(index_file, **columns)
+    return HeaderIndex(directory, columns)
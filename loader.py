@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+DataLoader construction for train/train_cv.
+
+With config.fast_loader the loader uses pinned memory and (on torch >= 1.7)
+persistent workers, and is wrapped in a DeviceLoader that prepares the next
+batch while the current one is in use: a background thread pulls batches out
+of the DataLoader (so collation overlaps the training step even on CPU), and
+on CUDA the host to device copy of the next batch runs non_blocking on a side
+stream.
+'''
+import inspect
+import threading
+from queue import Queue, Full
+import torch
+from torch.utils.data import DataLoader
+from config import config
+
+_DATALOADER_ARGS = inspect.signature(DataLoader.__init__).parameters
+
+
+class DeviceLoader(object):
+    """
+    Iterates the (inputs, target) batches of loader already on device,
+    with up to prefetch batches fetched ahead of the consumer.
+    """
+    def __init__(self, loader, device, prefetch=2):
+        self.loader = loader
+        self.device = device
+        self.prefetch = prefetch
+        self.dataset = loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _background(self):
+        queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(batch):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # also reached when the consumer stops early, the producer exits at its next put
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        batches = self._background()
+        if self.device.type != 'cuda':
+            for batch in batches:
+                yield tuple(t.to(self.device) for t in batch)
+            return
+
+        # double buffer: the copy of batch k+1 is issued on a side stream before batch k is handed out
+        stream = torch.cuda.Stream(self.device)
+        current = None
+        for batch in batches:
+            with torch.cuda.stream(stream):
+                staged = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            if current is not None:
+                yield current
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for t in staged:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            current = staged
+        if current is not None:
+            yield current
+
+
+def supports_prefetch_factor():
+    # DataLoader(prefetch_factor=) exists from torch 1.7 on
+    return 'prefetch_factor' in _DATALOADER_ARGS
+
+
+def make_loader(dataset, device, batch_size, shuffle=False, drop_last=False, num_workers=0, collate_fn=None,
+                prefetch_factor=None):
+    '''
+    DataLoader over dataset, wrapped in a DeviceLoader when config.fast_loader is on
+    :param prefetch_factor: batches loaded ahead by every worker, ignored without workers or on torch < 1.7
+    '''
+    kwargs = dict(batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=num_workers)
+    if collate_fn is not None:
+        kwargs['collate_fn'] = collate_fn
+    if prefetch_factor is not None and num_workers > 0 and supports_prefetch_factor():
+        kwargs['prefetch_factor'] = prefetch_factor
+    if not config.fast_loader:
+        return DataLoader(dataset, **kwargs)
+
+    kwargs['pin_memory'] = device.type == 'cuda'
+    if num_workers > 0 and 'persistent_workers' in _DATALOADER_ARGS:
+        # workers survive between epochs instead of being forked again for every epoch
+        kwargs['persistent_workers'] = True
+    return DeviceLoader(DataLoader(dataset, **kwargs), device, prefetch=config.loader_prefetch)
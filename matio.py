@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+Minimal reader for the challenge .mat recordings.
+
+The recordings hold one uncompressed numeric matrix ('val', int16). Instead of
+going through scipy.io.loadmat, the file is read in one call and the matrix is
+exposed with np.frombuffer after parsing the fixed MAT v4 / v5 headers. Anything
+else (compressed, complex, sparse, cell or struct variables) falls back to loadmat.
+'''
+import os, struct
+import numpy as np
+from scipy.io import loadmat
+
+# MAT v4 precision digit P of the type code MOPT
+V4_DTYPES = {0: 'f8', 1: 'f4', 2: 'i4', 3: 'i2', 4: 'u2', 5: 'u1'}
+# MAT v5 data types (miINT8 ...) and array classes (mxDOUBLE_CLASS ...)
+V5_DTYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8'}
+V5_CLASSES = {6: 'f8', 7: 'f4', 8: 'i1', 9: 'u1', 10: 'i2', 11: 'u2', 12: 'i4', 13: 'u4', 14: 'i8', 15: 'u8'}
+MI_MATRIX = 14
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _read_v4(buf, name):
+    offset = 0
+    while offset + 20 <= len(buf):
+        mopt = struct.unpack_from('<i', buf, offset)[0]
+        endian = '<' if 0 <= mopt < 5000 else '>'
+        mopt, mrows, ncols, imagf, namlen = struct.unpack_from(endian + '5i', buf, offset)
+        m, o, p, t = mopt // 1000, mopt // 100 % 10, mopt // 10 % 10, mopt % 10
+        if m > 1 or o != 0 or p not in V4_DTYPES:
+            raise Unsupported('MAT v4 type {}'.format(mopt))
+        offset += 20
+        var = bytes(buf[offset:offset + namlen]).rstrip(b'\x00').decode('latin1')
+        offset += namlen
+        dtype = np.dtype(V4_DTYPES[p]).newbyteorder(endian)
+        size = mrows * ncols * dtype.itemsize * (2 if imagf else 1)
+        if var == name:
+            if imagf or t != 0:
+                raise Unsupported('complex or non numeric MAT v4 variable')
+            # stored column major
+            return np.frombuffer(buf, dtype, mrows * ncols, offset).reshape(ncols, mrows).T
+        offset += size
+    raise KeyError(name)
+
+
+def _tag(buf, offset, endian):
+    # (data type, byte count, data offset, next element offset), handles the small element format
+    mtype, nbytes = struct.unpack_from(endian + '2I', buf, offset)
+    if mtype >> 16:
+        return mtype & 0xFFFF, mtype >> 16, offset + 4, offset + 8
+    return mtype, nbytes, offset + 8, offset + 8 + (nbytes + 7) // 8 * 8
+
+
+def _read_v5(buf, name):
+    endian = '<' if bytes(buf[126:128]) == b'IM' else '>'
+    offset = 128
+    while offset + 8 <= len(buf):
+        mtype, nbytes, start, offset = _tag(buf, offset, endian)
+        if mtype != MI_MATRIX:
+            # compressed (miCOMPRESSED) or unknown elements
+            raise Unsupported('MAT v5 element type {}'.format(mtype))
+        end = start + nbytes
+        # array flags
+        _, _, fstart, pos = _tag(buf, start, endian)
+        flags = struct.unpack_from(endian + 'I', buf, fstart)[0]
+        mclass, is_complex = flags & 0xFF, flags & 0x800
+        # dimensions
+        _, dbytes, dstart, pos = _tag(buf, pos, endian)
+        dims = struct.unpack_from(endian + '{}i'.format(dbytes // 4), buf, dstart)
+        # name
+        _, nbytes, nstart, pos = _tag(buf, pos, endian)
+        var = bytes(buf[nstart:nstart + nbytes]).decode('latin1')
+        if var == name:
+            if mclass not in V5_CLASSES or is_complex or len(dims) != 2:
+                raise Unsupported('MAT v5 class {}'.format(mclass))
+            dtype, nbytes, start, _ = _tag(buf, pos, endian)
+            if dtype not in V5_DTYPES or start + nbytes > end:
+                raise Unsupported('MAT v5 data type {}'.format(dtype))
+            data = np.frombuffer(buf, np.dtype(V5_DTYPES[dtype]).newbyteorder(endian),
+                                 dims[0] * dims[1], start).reshape(dims[1], dims[0]).T
+            # stored type may be narrower than the class (savemat of small values)
+            return data.astype(V5_CLASSES[mclass], copy=False)
+        offset = end + (-end) % 8
+    raise KeyError(name)
+
+
+def load_val(filename, name='val'):
+    '''
+    :param filename: path of the .mat file
+    :return: the matrix name as loadmat(filename)[name] would return it, but without copying out of the file buffer
+    '''
+    with open(filename, 'rb') as f:
+        # writable buffer, so the returned array behaves like a loadmat one
+        buf = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(buf)
+    try:
+        if len(buf) >= 128 and buf[:6] == b'MATLAB' and buf[124:126] in (b'\x00\x01', b'\x01\x00'):
+            return _read_v5(buf, name)
+        return _read_v4(buf, name)
+    except (Unsupported, KeyError, struct.error, ValueError):
+        return loadmat(filename)[name]
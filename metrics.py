@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Vectorized versions of the PhysioNet/CinC 2020 scoring functions, shared by
+utils.py, eval.py and evaluate_12ECG_score.py. They return the same values as
+the loop implementations of the official scorer (evaluation/evaluate_12ECG_score.py),
+up to floating point summation order; tests/test_metrics.py checks that.
+'''
+import numpy as np
+
+
+# Compute modified confusion matrix for multi-class, multi-label tasks.
+def compute_modified_confusion_matrix(labels, outputs):
+    '''
+    Binary multi-class, multi-label confusion matrix, rows are the labels and columns the outputs:
+    every recording adds 1/normalization to A[j, k] for each positive label j and positive output k,
+    normalization being its number of classes positive in the labels or the outputs (at least 1).
+    '''
+    labels = np.asarray(labels) != 0
+    outputs = np.asarray(outputs) != 0
+    normalization = np.maximum(np.sum(labels | outputs, axis=1), 1).astype(np.float64)
+    return np.dot((labels / normalization[:, None]).T, outputs.astype(np.float64))
+
+
+# Compute macro AUROC and macro AUPRC.
+def compute_auc(labels, outputs):
+    '''
+    All classes at once: the records of every class are sorted by decreasing output, and the TPs/FPs
+    at every distinct output value are cumulative sums taken at the last record of each run of ties.
+    The areas are summed in threshold order, like the official scorer.
+    :return: macro AUROC, macro AUPRC
+    '''
+    # one row per class, so that the sorts and cumulative sums run over contiguous memory
+    labels = np.ascontiguousarray((np.asarray(labels) != 0).T)
+    outputs = np.ascontiguousarray(np.asarray(outputs, dtype=np.float64).T)
+    num_classes, num_recordings = np.shape(labels)
+
+    order = np.argsort(outputs, axis=1)[:, ::-1]
+    scores = np.take_along_axis(outputs, order, axis=1)
+    tp = np.cumsum(np.take_along_axis(labels, order, axis=1), axis=1)
+    fp = np.arange(1, num_recordings + 1) - tp
+
+    # within a run of equal outputs, every record takes the counts of the last one, so the
+    # repeated points add nothing to the areas
+    last = np.ones((num_classes, num_recordings), dtype=bool)
+    last[:, :-1] = scores[:, :-1] != scores[:, 1:]
+    end = np.where(last, np.arange(num_recordings), num_recordings)
+    end = np.minimum.accumulate(end[:, ::-1], axis=1)[:, ::-1]
+    tp = np.take_along_axis(tp, end, axis=1)
+    fp = np.take_along_axis(fp, end, axis=1)
+
+    # the threshold above the largest output, where nothing is positive
+    zeros = np.zeros((num_classes, 1))
+    tp = np.concatenate([zeros, tp], axis=1)
+    fp = np.concatenate([zeros, fp], axis=1)
+    positives, negatives = tp[:, -1:], fp[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = tp / positives
+        tnr = (negatives - fp) / negatives
+        ppv = tp / (tp + fp)
+
+    # sequential sums (cumsum) add the terms in the same order as the official loops
+    auroc = np.cumsum(0.5 * (tpr[:, 1:] - tpr[:, :-1]) * (tnr[:, 1:] + tnr[:, :-1]), axis=1)[:, -1]
+    auprc = np.cumsum((tpr[:, 1:] - tpr[:, :-1]) * ppv[:, 1:], axis=1)[:, -1]
+
+    # Compute macro AUROC and macro AUPRC across classes.
+    macro_auroc = np.nanmean(auroc)
+    macro_auprc = np.nanmean(auprc)
+
+    return macro_auroc, macro_auprc
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Mixed precision for training, validation and inference (config.precision).
+
+    fp32  plain float32, the default
+    bf16  autocast to bfloat16 on CPU or CUDA (torch >= 1.10); bfloat16 has the
+          exponent range of float32, so the loss needs no scaling
+    fp16  autocast to float16 on CUDA (torch >= 1.6), with dynamic loss scaling
+          (torch.cuda.amp.GradScaler) against gradient underflow
+
+Weights and optimizer state stay float32 in every mode, so checkpoints do not
+depend on the precision they were trained in. Model outputs are cast back to
+float32 before the loss and the metrics.
+'''
+import contextlib
+import torch
+from config import config
+
+PRECISIONS = ('fp32', 'bf16', 'fp16')
+
+
+def check(device, precision=None):
+    '''
+    :return: precision (config.precision if None), raises ValueError if this torch/device cannot run it
+    '''
+    precision = precision or config.precision
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of {}, got {!r}".format(PRECISIONS, precision))
+    if precision == 'bf16' and not hasattr(torch, 'autocast'):
+        raise ValueError("bf16 needs torch >= 1.10 (torch.autocast), this is torch {}".format(torch.__version__))
+    if precision == 'fp16' and not (device.type == 'cuda' and hasattr(torch.cuda, 'amp')):
+        raise ValueError("fp16 needs a CUDA device and torch >= 1.6 (torch.cuda.amp)")
+    return precision
+
+
+def autocast(device, precision=None):
+    '''context manager running the forward pass (and loss) in precision on device'''
+    precision = check(device, precision)
+    if precision == 'fp32':
+        return contextlib.suppress()
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=dtype)
+    # fp16 on torch 1.6 - 1.9
+    return torch.cuda.amp.autocast()
+
+
+class _NoScaler(object):
+    # GradScaler interface for the precisions that need no loss scaling
+    def scale(self, loss):
+        return loss
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+
+def grad_scaler(device, precision=None):
+    '''
+    loss scaler for train_epoch: scaler.scale(loss).backward(); scaler.step(optimizer); scaler.update()
+    '''
+    if check(device, precision) == 'fp16':
+        return torch.cuda.amp.GradScaler()
+    return _NoScaler()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+Recording preprocessing shared by training (signal store), inference
+(run_12ECG_classifier) and ECGDataset: bring the recording to FS, pad or
+truncate it to SIGLEN samples and divide by the ADC gain.
+'''
+import numpy as np
+from matio import load_val
+from header_index import read_header
+from resampling import resample, resample_group
+from store import record_name
+
+# bump when the output of Preprocessor changes, invalidates the cached signal stores
+VERSION = 2
+
+
+class Preprocessor(object):
+    """
+    preprocessor(sig, fs, adc_gain) handles one (12, T) recording,
+    preprocessor.batch(sigs, fs, adc_gain) a list of them; both return float32.
+    load/load_batch read the records from disk, taking fs and gain from headers
+    (a header_index.HeaderIndex) when given and from the .hea file otherwise.
+    """
+    def __init__(self, FS=500, SIGLEN=500*10, headers=None):
+        self.FS = FS
+        self.SIGLEN = SIGLEN
+        self.headers = headers
+
+    def resample(self, sig, fs):
+        if fs == self.FS * 2:
+            return sig[:, ::2]
+        # polyphase, no-op when fs == FS
+        return resample(sig, fs, self.FS, axis=-1)
+
+    def fit(self, sig, out):
+        # truncate or zero pad to SIGLEN
+        n = min(sig.shape[-1], self.SIGLEN)
+        out[..., :n] = sig[..., :n]
+        out[..., n:] = 0
+        return out
+
+    def __call__(self, sig, fs, adc_gain, out=None):
+        if out is None:
+            out = np.empty((sig.shape[0], self.SIGLEN), dtype=np.float32)
+        self.fit(self.resample(sig, fs), out)
+        out /= adc_gain
+        return out
+
+    def windows(self, sig, fs, adc_gain, stride, max_windows=None):
+        '''
+        Cut one recording into SIGLEN windows for inference instead of truncating it.
+        The last window is aligned to the end of the recording so the tail is always covered;
+        recordings up to SIGLEN samples give the single window __call__ would return.
+        :param stride: samples (at FS) between window starts
+        :param max_windows: keep at most this many windows, evenly spread over the recording
+        :return: (W, 12, SIGLEN) float32
+        '''
+        sig = self.resample(sig, fs)
+        n = sig.shape[-1]
+        if n <= self.SIGLEN:
+            return self(sig, self.FS, adc_gain)[None]
+
+        starts = np.arange(0, n - self.SIGLEN + 1, stride)
+        if starts[-1] != n - self.SIGLEN:
+            starts = np.append(starts, n - self.SIGLEN)
+        if max_windows is not None and len(starts) > max_windows:
+            starts = starts[np.linspace(0, len(starts) - 1, max_windows).round().astype(int)]
+
+        # (n - SIGLEN + 1, 12, SIGLEN) strided view, only the selected windows are copied
+        sig = np.asarray(sig)
+        view = np.lib.stride_tricks.as_strided(sig, shape=(n - self.SIGLEN + 1, sig.shape[0], self.SIGLEN),
+                                               strides=(sig.strides[1], sig.strides[0], sig.strides[1]),
+                                               writeable=False)
+        out = view[starts].astype(np.float32, copy=False)
+        out /= adc_gain
+        return out
+
+    def batch(self, sigs, fs, adc_gain, out=None):
+        '''
+        :param sigs: list of (12, T) recordings, T may differ
+        :param fs: sampling rate of every recording (or one for all)
+        :param adc_gain: gain of every recording (or one for all)
+        :return: (N, 12, SIGLEN) float32
+        '''
+        n = len(sigs)
+        fs = np.broadcast_to(np.asarray(fs), (n,))
+        adc_gain = np.broadcast_to(np.asarray(adc_gain, dtype=np.float32), (n,))
+        if out is None:
+            out = np.empty((n, sigs[0].shape[0], self.SIGLEN), dtype=np.float32)
+
+        # every rate is handled once: 2*FS is decimated, others are resampled record-stacked
+        sigs = list(sigs)
+        for rate in np.unique(fs):
+            idx = np.flatnonzero(fs == rate)
+            if rate == self.FS * 2:
+                for i in idx:
+                    sigs[i] = sigs[i][:, ::2]
+            elif rate != self.FS:
+                for i, sig in zip(idx, resample_group([sigs[i] for i in idx], int(rate), self.FS)):
+                    sigs[i] = sig
+
+        for i, sig in enumerate(sigs):
+            self.fit(sig, out[i])
+        out /= adc_gain[:, None, None]
+        return out
+
+    def header(self, file):
+        name = record_name(file)
+        if self.headers is not None and name in self.headers:
+            return self.headers[name]
+        return read_header(file + '.hea')
+
+    def load(self, file):
+        # file: record path without extension
+        header = self.header(file)
+        return self(load_val(file + '.mat'), header['fs'], header['adc_gain'])
+
+    def load_batch(self, files):
+        headers = [self.header(file) for file in files]
+        sigs = [load_val(file + '.mat') for file in files]
+        return self.batch(sigs, [h['fs'] for h in headers], [h['adc_gain'] for h in headers])
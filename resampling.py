@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+'''
+Rational polyphase resampling of multi-lead recordings.
+
+Replaces the FFT based scipy.signal.resample for recordings whose rate is not
+a multiple of the target rate (e.g. 257 Hz INCART). The anti-alias filter of
+every (fs_in, fs_out) pair is designed once and cached; all leads, and all
+records of the same rate and length, go through one resample_poly call.
+'''
+from functools import lru_cache
+from math import gcd
+import numpy as np
+from scipy.signal import firwin, resample_poly
+
+
+@lru_cache(maxsize=32)
+def resample_plan(fs_in, fs_out):
+    '''
+    :return: (up, down, h), h is the same Kaiser windowed low pass resample_poly designs by default
+    '''
+    g = gcd(fs_in, fs_out)
+    up, down = fs_out // g, fs_in // g
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+    return up, down, h
+
+
+def resample(x, fs_in, fs_out, axis=-1):
+    '''
+    Resample x from fs_in to fs_out along axis; every other axis (leads, records) is batched.
+    The output has ceil(n * fs_out / fs_in) samples.
+    '''
+    fs_in, fs_out = int(fs_in), int(fs_out)
+    if fs_in == fs_out:
+        return x
+    up, down, h = resample_plan(fs_in, fs_out)
+    return resample_poly(x, up, down, axis=axis, window=h)
+
+
+def resample_group(sigs, fs_in, fs_out):
+    '''
+    Resample a list of (12, T) recordings that share fs_in. Recordings of equal length are stacked
+    and resampled in a single call.
+    '''
+    out = [None] * len(sigs)
+    lengths = np.array([sig.shape[-1] for sig in sigs])
+    for length in np.unique(lengths):
+        idx = np.flatnonzero(lengths == length)
+        y = resample(np.stack([sigs[i] for i in idx]), fs_in, fs_out, axis=-1)
+        for j, i in enumerate(idx):
+            out[i] = y[j]
+    return out
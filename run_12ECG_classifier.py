@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import numpy as np, os, sys
+import os, sys
 import joblib
 from get_12ECG_features import get_12ECG_features
 
@@ -9,10 +9,25 @@ import models
 from dataset import transform
 import torch
 import pandas as pd
-from scipy import signal
+from header_index import parse_header
+from preprocess import Preprocessor
+import precision
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+preprocessor = Preprocessor(FS=500, SIGLEN=500*10)
+
+def predict_windows(model, x):
+    '''
+    :param x: (W, 12, SIGLEN) windows of one recording
+    :return: (num_classes,) probabilities pooled over the windows with config.infer_pool
+    '''
+    with precision.autocast(device):
+        probs = torch.cat([torch.sigmoid(model(x[i:i + config.infer_batch_size].to(device)).float())
+                           for i in range(0, len(x), config.infer_batch_size)])
+    probs = probs.max(dim=0)[0] if config.infer_pool == 'max' else probs.mean(dim=0)
+    return probs.cpu().numpy()
+
 def run_12ECG_classifier(data,header_data,loaded_model):
 
 
@@ -22,47 +37,23 @@ def run_12ECG_classifier(data,header_data,loaded_model):
 
     with torch.no_grad():
         sig = data
-        FS = 500
-        SIGLEN = FS * 10
-
-        fs = int(header_data[0].split(' ')[2])
-        siglen = int(header_data[0].split(' ')[3])
-        adc_gain = int(header_data[1].split(' ')[2].split('/')[0])
-
-        # print(fs,siglen,adc_gain)
-
-        if fs == FS * 2 :
-            # sig = signal.resample(sig.T, int(annot.siglen/annot.fs * FS)).T
-            sig = sig[:,::2]
-        elif fs == FS:
-            pass#raise ValueError("fs wrong")
-        elif fs != FS:
-            sig = signal.resample(sig.T, int(siglen/fs * FS)).T
-
-        siglen = sig.shape[1]
-        # print(siglen)
-
-        if siglen !=  SIGLEN:
-            sig_ext = np.zeros([12,SIGLEN])
-
-        if siglen <  SIGLEN:
-            sig_ext[:,:siglen] = sig
-        if siglen >  SIGLEN:
-            sig_ext = sig[:,:SIGLEN]
-
-        if siglen !=  SIGLEN:
-            sig = sig_ext
 
-        sig = sig/adc_gain
+        header = parse_header(header_data)
+        fs = header['fs']
+        adc_gain = header['adc_gain']
 
-        x = transform(sig.T,train=False).unsqueeze(0).to(device)
+        # same resample/pad/gain pipeline as the training store
+        if config.infer_window:
+            x = torch.from_numpy(preprocessor.windows(sig, fs, adc_gain, config.infer_stride, config.infer_max_windows))
+        else:
+            x = transform(preprocessor(sig, fs, adc_gain).T,train=False).unsqueeze(0)
 
         # k-fold
         ''' '''
         output = 0
         kfold = 5
         for fold in range(kfold):
-            output += torch.sigmoid(loaded_model[fold](x)).squeeze().cpu().numpy()
+            output += predict_windows(loaded_model[fold], x)
         output = output/kfold
         mapping = dict(zip([str(i) for i in dx_mapping_scored],output))
         output = [mapping[key] for key in sorted(mapping.keys())]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+Sharded, sequentially read copy of a signal store for corpora larger than RAM.
+
+export_shards packs the preprocessed records of a SignalStore and their label
+vectors into a few large files (shards/shard_00000.dat, ...): the uint8 label
+matrix of the shard followed by its N x 12 x SIGLEN float32 signals. ShardedECGDataset
+streams them back with shard-level shuffling plus a shuffle buffer, every
+DataLoader worker reading its own shards front to back.
+'''
+import os, shutil, hashlib
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
+from store import INDEX_FILE, NUM_LEADS
+from dataset import transform, AugmentCollate
+
+SHARD_DIR = 'shards'
+SHARD_FILE = 'shard_{:05d}.dat'
+SHARD_INDEX = 'shards.npz'
+
+
+def shard_dir(store_dir):
+    return os.path.join(store_dir, SHARD_DIR)
+
+
+def _signature(store, labels):
+    # identifies the store rows and labels a set of shards was written from
+    fingerprints = np.load(os.path.join(store.store_dir, INDEX_FILE))['fingerprints']
+    h = hashlib.sha1()
+    for a in (store.names.astype(str), fingerprints, labels):
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+def export_shards(store, names, labels, records_per_shard=1024):
+    '''
+    Write every labelled record of store into shards next to it, skipped when shards of the same
+    store rows and labels already exist.
+    :param names, labels: record names and (N, num_classes) uint8 label matrix, see split.load_fold
+    :return: shard directory
+    '''
+    labels_of = dict(zip(names.tolist(), range(len(names))))
+    rows = np.array([row for row, name in enumerate(store.names.tolist()) if name in labels_of], dtype=np.int64)
+    names = store.names[rows]
+    labels = np.ascontiguousarray(labels[[labels_of[name] for name in names.tolist()]], dtype=np.uint8)
+    num_classes = labels.shape[1]
+
+    directory = shard_dir(store.store_dir)
+    index_file = os.path.join(directory, SHARD_INDEX)
+    signature = _signature(store, labels)
+    if os.path.isfile(index_file) and str(np.load(index_file)['signature']) == signature:
+        return directory
+    if os.path.isdir(directory):
+        # stale shards, the index goes first
+        if os.path.isfile(index_file):
+            os.remove(index_file)
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    counts = []
+    for shard, start in enumerate(range(0, len(rows), records_per_shard)):
+        part = rows[start:start + records_per_shard]
+        with open(os.path.join(directory, SHARD_FILE.format(shard)), 'wb') as f:
+            labels[start:start + len(part)].tofile(f)
+            # rows are in store order, so the store is read sequentially as well
+            for i in range(0, len(part), 64):
+                np.ascontiguousarray(store.signals[part[i:i + 64]]).tofile(f)
+        counts.append(len(part))
+    # the index is written last and marks the shards as complete
+    np.savez(index_file, names=names, counts=np.array(counts, dtype=np.int64), SIGLEN=store.SIGLEN,
+             num_classes=num_classes, signature=signature)
+    print("shards: {} records in {} shards".format(len(rows), len(counts)))
+    return directory
+
+
+class ShardedECGDataset(IterableDataset):
+    """
+    Streaming counterpart of dataset.ECGDataset over the shards written by export_shards,
+    yielding the same (x, target) pairs for the train or val records of data_path.
+    Training shuffles the shard order every epoch, deals the shards round robin to the
+    DataLoader workers and mixes records through a buffer of buffer_size samples;
+    validation reads the shards in order and skips blocks without val records.
+    """
+    def __init__(self, data_path, shard_dir, train=True, batch_augment=False, buffer_size=2048, block=64):
+        super(ShardedECGDataset, self).__init__()
+        dd = torch.load(data_path)
+        self.train = train
+        self.wc = 1. / np.log(dd['wc'])
+        self.shard_dir = shard_dir
+        self.buffer_size = buffer_size
+        self.block = block
+        index = np.load(os.path.join(shard_dir, SHARD_INDEX))
+        self.counts = index['counts']
+        self.SIGLEN = int(index['SIGLEN'])
+        self.num_classes = int(index['num_classes'])
+        # records of this split, as a mask per shard
+        wanted = set(dd['names'][dd['train'] if train else dd['val']].tolist())
+        member = np.array([name in wanted for name in index['names'].tolist()], dtype=bool)
+        self.members = np.split(member, np.cumsum(self.counts)[:-1])
+        self.size = int(member.sum())
+        self.batch_augment = batch_augment and train
+        self.collate_fn = AugmentCollate() if self.batch_augment else default_collate
+        # iterations started on this copy; persistent DataLoader workers keep their copy across epochs,
+        # where info.seed stays the same, and all of them count in step
+        self.epoch = 0
+
+    def read_shard(self, shard):
+        # (sig, label) of the members of one shard, read front to back block by block
+        n, members = self.counts[shard], self.members[shard]
+        record = NUM_LEADS * self.SIGLEN
+        with open(os.path.join(self.shard_dir, SHARD_FILE.format(shard)), 'rb') as f:
+            labels = np.fromfile(f, dtype=np.uint8, count=n * self.num_classes).reshape(n, self.num_classes)
+            for start in range(0, n, self.block):
+                stop = min(start + self.block, n)
+                keep = np.flatnonzero(members[start:stop])
+                if len(keep) == 0:
+                    f.seek((stop - start) * record * 4, os.SEEK_CUR)
+                    continue
+                sigs = np.fromfile(f, dtype=np.float32, count=(stop - start) * record)
+                sigs = sigs.reshape(stop - start, NUM_LEADS, self.SIGLEN)
+                for i in keep:
+                    yield sigs[i], labels[start + i]
+
+    def sample(self, sig, label):
+        if self.batch_augment:
+            x = torch.from_numpy(sig)
+        else:
+            x = transform(sig.T, self.train)
+        return x, torch.from_numpy(label)
+
+    def __iter__(self):
+        shards = [shard for shard in range(len(self.counts)) if self.members[shard].any()]
+        info = get_worker_info()
+        worker, workers = (0, 1) if info is None else (info.id, info.num_workers)
+        if not self.train:
+            for shard in shards[worker::workers]:
+                for sig, label in self.read_shard(shard):
+                    yield self.sample(sig, label)
+            return
+
+        # base seed of this epoch, the same in every worker so they agree on the shard order
+        self.epoch += 1
+        seed = int(torch.empty((), dtype=torch.int64).random_().item()) if info is None else info.seed - info.id + self.epoch
+        order = np.random.RandomState(seed % 2 ** 32).permutation(shards)
+        rng = np.random.RandomState((seed + worker + 1) % 2 ** 32)
+        buffer = []
+        for shard in order[worker::workers]:
+            for item in self.read_shard(shard):
+                # copied, so the buffer does not keep whole read blocks alive
+                item = (item[0].copy(), item[1])
+                if len(buffer) < self.buffer_size:
+                    buffer.append(item)
+                    continue
+                i = rng.randint(len(buffer))
+                buffer[i], item = item, buffer[i]
+                yield self.sample(*item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self.sample(*item)
+
+    def __len__(self):
+        return self.size
@@ -1,91 +1,27 @@
-import os,sys
-import wfdb
+import os,sys,hashlib
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import torch
-from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+from config import config
+from header_index import load_header_index
+from stratify import iterative_stratification
 
 def get_labels(path):
 
-    files = []
-    # for path in path_list:
-    for file in tqdm(os.listdir(path)):
-        if file.endswith('.mat'):
-            files.append(path +"/"+file.split(".")[0])
-
-    label1 = []
-    label2 = []
-    label3 = []
-    label4 = []
-    sig_len = []
-    sex = []
-    age = []
-    fs = []
-    label_num = []
-    class_mapping = {}
-    classes_count = {}
-    str_label = []
-    label_files = []
-    for _,file in tqdm(enumerate(files)):
-        annotation = wfdb.rdheader(file)
-        #print(annotation.__dict__)
-        if annotation.fs < 500:
-            continue
+    # headers come from the columnar header index instead of a wfdb.rdheader call per file
+    headers = load_header_index(path, config.cache_dir)
+
+    keep = (headers.fs >= 500) & (headers.dx != "Unknown") & (headers.dx != "")
+    str_label = headers.dx[keep]
 
-        label_files.append(file)
-        sig_len.append(annotation.sig_len)
-        fs.append(annotation.fs)
-
-        sex.append(annotation.comments[1].split(": ")[1])
-        try:
-            age.append(int(annotation.comments[0].split(": ")[1]))
-        except:
-            age.append(np.nan)
-
-        '''  '''
-        l1 = annotation.comments[2].split(": ")[1]
-        if l1 != "Unknown":
-            str_label.append(l1)
-            labels = l1.split(",")
-            label_num.append(len(labels))
-
-            for class_name in labels:
-                if class_name not in class_mapping:
-                    class_mapping[class_name] = len(class_mapping)
-
-                if class_name not in classes_count:
-                    classes_count[class_name] = 1
-                else:
-                    classes_count[class_name] += 1
-
-            # label1.append(labels[0])
-            # try:
-            #     label2.append(labels[1])
-            # except:
-            #     label2.append('')
-
-            # try:
-            #     label3.append(labels[2])
-            # except:
-            #     label3.append('')
-
-            # try:
-            #     label4.append(labels[3])
-            # except:
-            #     label4.append('')
-
-    labels = pd.DataFrame({"record_name":label_files,
-                           "length":sig_len,
-                           "age":age,
-                           "sex":sex,
-                           "fs":fs,
-                           "label_num":label_num,
+    labels = pd.DataFrame({"record_name":np.array(headers.paths(), dtype=object)[keep],
+                           "length":headers.sig_len[keep],
+                           "age":headers.age[keep],
+                           "sex":headers.sex[keep],
+                           "fs":headers.fs[keep],
+                           "label_num":np.char.count(str_label, ",") + 1,
                            "labels":str_label,
-                           # "label1":label1,
-                           # "label2":label2,
-                           # "label3":label3,
-                           # "label4":label4
                            })
 
     return labels
@@ -188,78 +124,101 @@ def load_weights(weight_file, classes):
 # #{0:"AF",1:"I-AVB",2:"LBBB",3:"Normal",4:"PAC",5:"PVC",6:"RBBB",7:"STD",8:"STE"}
 
 
-def split_data_cv(file2idx, num_classes=9, kfold=5):
-    X_train_cv = []
-    X_val_cv   = []
-    X = []
-    y = np.zeros([len(file2idx),num_classes])
-    #print(y.shape)
-    for i,(file, list_idx) in enumerate(file2idx.items()):
-        #print(file, list_idx)
-        X.append(file)
-        y[i,file2idx[file]] = 1
-
-    X = np.array(X)
-
-    mskf = MultilabelStratifiedKFold(n_splits=kfold, random_state=42)
-    for train_index, test_index in mskf.split(X, y):
-        #print("TRAIN:", train_index, "TEST:", test_index)
-        X_train, X_val = X[train_index], X[test_index]
-        X_train_cv.append(list(X_train))
-        X_val_cv.append(list(X_val))
-        #y_train, y_test = y[train_index], y[test_index]
+SPLIT_SEED = 42
+
+def split_data_cv(y, kfold=5, groups=None):
+    '''
+    :param y: (N, num_classes) label matrix
+    :param groups: optional group (e.g. patient) of every row, a group is never split across folds
+    :return: train and val row indices of every fold
+    '''
+    folds = iterative_stratification(y, kfold, groups=groups, seed=SPLIT_SEED)
+    X_train_cv = [np.flatnonzero(folds != i) for i in range(kfold)]
+    X_val_cv   = [np.flatnonzero(folds == i) for i in range(kfold)]
     return X_train_cv,X_val_cv
 
 
-def count_labels(data, file2idx, num_classes=9):
+def count_labels(y, rows):
     '''
     统计每个类别的样本数
-    :param data:
-    :param file2idx:
+    :param y: (N, num_classes) label matrix
+    :param rows: row indices
     :return:
     '''
-    cc = [0] * num_classes
-    for fp in data:
-        for i in file2idx[fp]:
-            cc[i] += 1
-    return np.array(cc)
+    return y[rows].sum(axis=0, dtype=np.int64)
 
 
+def load_fold(data_path):
+    '''
+    Load a fold file written by train_cv_data with its label matrix unpacked.
+    dd['names'][i] is the record name of row i and dd['labels'][i] its (num_classes,) uint8 label vector;
+    dd['train'] and dd['val'] are row indices.
+    '''
+    dd = torch.load(data_path)
+    dd['labels'] = np.ascontiguousarray(np.unpackbits(dd['labels'], axis=1)[:, :dd['num_classes']])
+    return dd
+
 
 def train_cv_data(name2idx, idx2name,labels,kfold=5,dx_mapping=None,num_classes=9):
 
-    file2idx = dict()
+    names = []
+    rows = []
 
-    for i in range(labels.shape[0]):
-        label = []
-        idx = str(labels.iloc[i].record_name) + ".mat"
-        label = [dx_mapping[int(lab)] for lab in labels.iloc[i].labels.split(',') if int(lab) in dx_mapping.keys()]
+    for i, (record, dx) in enumerate(zip(labels.record_name.values, labels.labels.values)):
+        label = [dx_mapping[int(lab)] for lab in dx.split(',') if int(lab) in dx_mapping]
 
         if label == []:
             continue
 
-#         if ~np.isnan(labels_round1.iloc[i].label1):
-#             label.append(int(labels_round1.iloc[i].label1))
-#         if ~np.isnan(labels_round1.iloc[i].label2):
-#             label.append(int(labels_round1.iloc[i].label2))
-#         if ~np.isnan(labels_round1.iloc[i].label3):
-#             label.append(int(labels_round1.iloc[i].label3))
-
-        file2idx[idx] = label
-    print(len(file2idx))
-
-    train_cv, val_cv = split_data_cv(file2idx,num_classes=num_classes,kfold=kfold)
+        names.append(os.path.basename(record))
+        rows.append(label)
+    print(len(names))
+
+    # one uint8 row per record instead of a dict of lists, saved bit packed
+    y = np.zeros((len(names), num_classes), dtype=np.uint8)
+    for i, label in enumerate(rows):
+        y[i, label] = 1
+    names = np.array(names)
+
+    # fold of every record; reused from the last split if the labelled records and parameters are the same,
+    # new or relabelled records are assigned incrementally so existing folds stay put
+    params = repr((kfold, SPLIT_SEED, num_classes, sorted(idx2name.items())))
+    packed = np.packbits(y, axis=1)
+    digest = hashlib.sha1(params.encode('utf-8') + names.astype(str).tobytes() + packed.tobytes()).hexdigest()
+    meta = torch.load(config.split_meta) if os.path.isfile(config.split_meta) else None
+    if meta is not None and meta['params'] == params:
+        if meta['fingerprint'] == digest and all(os.path.isfile(config.train_data_cv.format(i)) for i in range(kfold)):
+            print("split: {} records unchanged, reusing folds".format(len(names)))
+            return
+        old = {name: (fold, label.tobytes()) for name, fold, label in zip(meta['names'].tolist(), meta['folds'], meta['labels'])}
+        folds = np.array([old[name][0] if name in old and old[name][1] == label.tobytes() else -1
+                          for name, label in zip(names.tolist(), packed)], dtype=np.int64)
+        print("split: {} records, {} new or relabelled assigned incrementally".format(len(names), int((folds < 0).sum())))
+        folds = iterative_stratification(y, kfold, folds=folds, seed=SPLIT_SEED)
+    else:
+        folds = np.full(len(names), -1, dtype=np.int64)
+        for i, val_index in enumerate(split_data_cv(y,kfold=kfold)[1]):
+            folds[val_index] = i
+    train_cv = [np.flatnonzero(folds != i) for i in range(kfold)]
+    val_cv = [np.flatnonzero(folds == i) for i in range(kfold)]
+
+    if not os.path.isdir(os.path.dirname(config.split_meta)):
+        os.makedirs(os.path.dirname(config.split_meta))
     for i in range(kfold):
-        wc=count_labels(train_cv[i],file2idx,num_classes=num_classes)
+        wc=count_labels(y,train_cv[i])
         print(len(train_cv[i]))
         print(len(val_cv[i]))
         print(wc)
 
-        wc1=count_labels(val_cv[i],file2idx,num_classes=num_classes)
+        wc1=count_labels(y,val_cv[i])
         print(wc1)
         print("**********************************************************************")
-        dd = {'train': train_cv[i], 'val': val_cv[i], "idx2name": idx2name, 'file2idx': file2idx,'wc':wc}
-        torch.save(dd, "./pth/round1_data_{}.pth".format(i))
+        dd = {'train': train_cv[i], 'val': val_cv[i], "idx2name": idx2name, 'names': names,
+              'labels': packed, 'num_classes': num_classes, 'wc':wc}
+        torch.save(dd, config.train_data_cv.format(i))
+    # written last, fold files of an interrupted run are never taken as up to date
+    torch.save({'params': params, 'fingerprint': digest, 'names': names, 'labels': packed, 'folds': folds},
+               config.split_meta)
 
 def split(path):
     # labels_round1 = pd.read_csv("./labels.csv")
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+'''
+Contiguous on-disk store for preprocessed recordings.
+
+All records live in one float32 array of shape N x 12 x SIGLEN (signals.dat)
+that is read back through np.memmap, plus an index (index.npz) mapping record
+names to rows and the source fingerprint of every row.
+
+Stores are kept in a cache directory (see cached_store), one entry per source
+directory and preprocessing parameters, and evicted least recently used first
+once the cache grows past its size limit.
+'''
+import os, time, shutil, hashlib
+import numpy as np
+import torch
+from multiprocessing import Pool
+
+SIGNALS_FILE = 'signals.dat'
+INDEX_FILE = 'index.npz'
+DONE_FILE = 'done.dat'
+LAST_USED_FILE = 'last_used'
+NUM_LEADS = 12
+
+
+def record_name(fid):
+    # './input/A0001.mat' -> 'A0001'
+    return os.path.basename(fid).split('.')[0]
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class SignalStore(object):
+    """
+    Read-only view of a store written by build_store.
+    store[name] returns a (12, SIGLEN) float32 view into the memory map, no copy is made.
+    Names are looked up with a binary search over numpy arrays rather than a dict, so a store
+    inherited by forked DataLoader workers holds no per-record Python objects.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, INDEX_FILE))
+        self.names = index['names']
+        self.shape = tuple(int(s) for s in index['shape'])
+        self.FS = int(index['FS'])
+        self.SIGLEN = int(index['SIGLEN'])
+        self._order = np.argsort(self.names, kind='stable')
+        self._sorted = self.names[self._order]
+        self._signals = None
+
+    @property
+    def signals(self):
+        # opened lazily so that every DataLoader worker maps the file itself
+        if self._signals is None:
+            self._signals = np.memmap(os.path.join(self.store_dir, SIGNALS_FILE),
+                                      dtype=np.float32, mode='r', shape=self.shape)
+        return self._signals
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_signals'] = None
+        return state
+
+    def rows(self, names, strict=True):
+        '''
+        :param names: array of record names
+        :param strict: raise KeyError for names not in the store, otherwise their row is -1
+        :return: int64 array of rows
+        '''
+        names = np.asarray(names)
+        pos = np.searchsorted(self._sorted, names).clip(0, len(self._sorted) - 1)
+        found = self._sorted[pos] == names
+        if strict and not found.all():
+            raise KeyError(str(names[~found][0]))
+        return np.where(found, self._order[pos], -1).astype(np.int64)
+
+    def row(self, fid):
+        return int(self.rows([record_name(fid)])[0])
+
+    def __getitem__(self, fid):
+        return self.signals[self.row(fid)]
+
+    def __contains__(self, fid):
+        return self.rows([record_name(fid)], strict=False)[0] >= 0
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class SharedSignalCache(object):
+    """
+    Rows of a SignalStore decoded once into a shared-memory tensor, so that every DataLoader
+    worker (and every fold of train_cv) reads the same copy from RAM.
+    Rows that do not fit into max_bytes are read from the store's memory map instead.
+    """
+    def __init__(self, store, max_bytes, fids=None):
+        self.store = store
+        rows = np.arange(len(store)) if fids is None else np.unique(store.rows([record_name(fid) for fid in fids]))
+        rows = rows[:max(0, int(max_bytes // (NUM_LEADS * store.SIGLEN * 4)))]
+        self.slots = np.full(len(store), -1, dtype=np.int64)
+        self.slots[rows] = np.arange(len(rows))
+        self.data = torch.empty((len(rows), NUM_LEADS, store.SIGLEN), dtype=torch.float32).share_memory_()
+        data = self.data.numpy()
+        for start in range(0, len(rows), 1024):
+            data[start:start + 1024] = store.signals[rows[start:start + 1024]]
+        print("ram cache: {}/{} records ({:.1f} GB)".format(len(rows), len(store), data.nbytes / 1024 ** 3))
+
+    def read(self, row):
+        slot = self.slots[row]
+        if slot < 0:
+            return self.store.signals[row]
+        return self.data[slot].numpy()
+
+    def __getitem__(self, fid):
+        return self.read(self.store.row(fid))
+
+
+def fingerprint(file):
+    # (size, mtime) of the .mat plus mtime of the .hea, enough to notice a re-exported record
+    mat = os.stat(file + '.mat')
+    hea = os.stat(file + '.hea')
+    return mat.st_size, mat.st_mtime_ns, hea.st_mtime_ns
+
+
+def _load_previous(store_dir, FS, SIGLEN):
+    # names, fingerprints and done flags of an earlier (possibly interrupted) build
+    index_file = os.path.join(store_dir, INDEX_FILE)
+    done_file = os.path.join(store_dir, DONE_FILE)
+    if not (os.path.isfile(index_file) and os.path.isfile(done_file)):
+        return None
+    index = np.load(index_file)
+    if 'fingerprints' not in index.files or int(index['FS']) != FS or int(index['SIGLEN']) != SIGLEN:
+        return None
+    done = np.fromfile(done_file, dtype=np.uint8)
+    if len(done) != len(index['names']):
+        return None
+    return index['names'], index['fingerprints'], done
+
+
+def _relayout(store_dir, names, fingerprints, shape, previous):
+    # write a fresh layout next to the old one, carrying over every finished row whose source is unchanged
+    signals_file = os.path.join(store_dir, SIGNALS_FILE)
+    done_file = os.path.join(store_dir, DONE_FILE)
+    signals = np.memmap(signals_file + '.tmp', dtype=np.float32, mode='w+', shape=shape)
+    done = np.memmap(done_file + '.tmp', dtype=np.uint8, mode='w+', shape=shape[:1])
+
+    if previous is not None:
+        old_names, old_fingerprints, old_done = previous
+        old_rows = {name: row for row, name in enumerate(old_names.tolist())}
+        old_signals = np.memmap(signals_file, dtype=np.float32, mode='r',
+                                shape=(len(old_names),) + shape[1:])
+        for row, name in enumerate(names.tolist()):
+            old = old_rows.get(name)
+            if old is not None and old_done[old] and np.array_equal(old_fingerprints[old], fingerprints[row]):
+                signals[row] = old_signals[old]
+                done[row] = 1
+        del old_signals
+
+    signals.flush()
+    done.flush()
+    del signals, done
+    # the done flags are removed first, so an interruption here never pairs old flags with new rows
+    if os.path.isfile(done_file):
+        os.remove(done_file)
+    os.replace(signals_file + '.tmp', signals_file)
+
+
+_worker = {}
+
+def _init_worker(store_dir, shape, process_fn):
+    _worker['signals'] = np.memmap(os.path.join(store_dir, SIGNALS_FILE), dtype=np.float32,
+                                   mode='r+', shape=shape)
+    _worker['process_fn'] = process_fn
+
+
+def _process_rows(task):
+    rows, files = task
+    _worker['signals'][rows] = _worker['process_fn'](files)
+    return rows
+
+
+def _chunks(pending, files, groups, chunk_size):
+    # chunks of rows that share a group (e.g. sampling rate), so process_fn can batch them
+    if groups is not None:
+        pending = pending[np.argsort(np.asarray(groups)[pending], kind='stable')]
+        bounds = np.flatnonzero(np.diff(np.asarray(groups)[pending])) + 1
+    else:
+        bounds = []
+    tasks = []
+    for part in np.split(pending, bounds):
+        for start in range(0, len(part), chunk_size):
+            rows = part[start:start + chunk_size]
+            tasks.append((rows, [files[row] for row in rows]))
+    return tasks
+
+
+def build_store(files, store_dir, process_fn, FS=500, SIGLEN=500*10, workers=None, progress=None,
+                groups=None, chunk_size=32):
+    '''
+    Preprocess every record into one contiguous memory-mapped array.
+    Records are processed in chunks by a pool of worker processes that write their rows straight
+    into the memory map. Finished rows are flagged in done.dat, so an interrupted build resumes
+    where it stopped and a rebuild only redoes records whose source files changed.
+    :param files: record paths without extension
+    :param process_fn: process_fn(files) -> (len(files), 12, SIGLEN) array, must be picklable
+    :param workers: number of worker processes, None for os.cpu_count()
+    :param progress: optional iterator wrapper, e.g. tqdm
+    :param groups: optional key per file, a chunk only holds files of one group
+    :return: SignalStore
+    '''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    names = np.array([record_name(f) for f in files])
+    fingerprints = np.array([fingerprint(f) for f in files], dtype=np.int64).reshape(-1, 3)
+    shape = (len(files), NUM_LEADS, SIGLEN)
+    done_file = os.path.join(store_dir, DONE_FILE)
+
+    previous = _load_previous(store_dir, FS, SIGLEN)
+    if previous is not None and np.array_equal(previous[0], names):
+        # same record list: resume in place, only rows whose source changed are redone
+        done = np.memmap(done_file, dtype=np.uint8, mode='r+', shape=shape[:1])
+        done[np.any(previous[1] != fingerprints, axis=1)] = 0
+        done.flush()
+        np.savez(os.path.join(store_dir, INDEX_FILE), names=names, shape=np.array(shape),
+                 FS=FS, SIGLEN=SIGLEN, fingerprints=fingerprints)
+    else:
+        _relayout(store_dir, names, fingerprints, shape, previous)
+        np.savez(os.path.join(store_dir, INDEX_FILE), names=names, shape=np.array(shape),
+                 FS=FS, SIGLEN=SIGLEN, fingerprints=fingerprints)
+        os.replace(done_file + '.tmp', done_file)
+        done = np.memmap(done_file, dtype=np.uint8, mode='r+', shape=shape[:1])
+
+    pending = np.flatnonzero(done == 0)
+    print("store: {} records, {} to preprocess".format(len(files), len(pending)))
+    if len(pending):
+        workers = workers or os.cpu_count()
+        tasks = _chunks(pending, files, groups, chunk_size)
+        initargs = (store_dir, shape, process_fn)
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=initargs)
+            results = pool.imap_unordered(_process_rows, tasks)
+        else:
+            pool = None
+            _init_worker(*initargs)
+            results = map(_process_rows, tasks)
+        if progress is not None:
+            results = progress(results, total=len(tasks))
+        try:
+            for rows in results:
+                # rows written through a shared mapping are in the page cache once the worker returns
+                done[rows] = 1
+        finally:
+            done.flush()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    del done
+
+    return SignalStore(store_dir)
+
+
+def cache_key(source_dir, **params):
+    text = repr((os.path.abspath(source_dir), sorted(params.items())))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def _entry_size(path):
+    # includes derived data kept inside the entry, e.g. shards
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _last_used(path):
+    last_used = os.path.join(path, LAST_USED_FILE)
+    return os.path.getmtime(last_used if os.path.isfile(last_used) else path)
+
+
+def evict_cache(cache_dir, max_bytes, keep=None):
+    '''
+    Remove least recently used stores until the cache holds at most max_bytes.
+    :param keep: store directory that must not be evicted
+    '''
+    entries = [(_last_used(entry.path), entry.path, _entry_size(entry.path))
+               for entry in os.scandir(cache_dir) if entry.is_dir()]
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        print("store cache: evicting {} ({:.1f} GB)".format(path, size / 1024 ** 3))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cached_store(files, source_dir, cache_dir, process_fn, FS=500, SIGLEN=500*10, version=1,
+                 max_bytes=None, workers=None, progress=None, groups=None):
+    '''
+    build_store inside a persistent cache. The entry is keyed by the source directory and the
+    preprocessing parameters (FS, SIGLEN, process_fn and its version, which covers resampling,
+    padding and gain handling); within an entry every row is validated against the fingerprint
+    of its source file, so stale records are reprocessed and unchanged ones are reused.
+    :param version: bump when process_fn changes its output
+    :param max_bytes: size limit of the whole cache, None for unbounded
+    :return: SignalStore
+    '''
+    process = getattr(process_fn, '__name__', type(process_fn).__name__)
+    key = cache_key(source_dir, FS=FS, SIGLEN=SIGLEN, version=version,
+                    process='{}.{}'.format(process_fn.__module__, process))
+    store_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    if max_bytes is not None:
+        # make room for this entry before it is (re)built
+        evict_cache(cache_dir, max_bytes - len(files) * NUM_LEADS * SIGLEN * 4, keep=store_dir)
+
+    store = build_store(files, store_dir, process_fn, FS=FS, SIGLEN=SIGLEN, workers=workers,
+                        progress=progress, groups=groups)
+    with open(os.path.join(store_dir, LAST_USED_FILE), 'w') as f:
+        f.write(time.strftime("%Y-%m-%d %H:%M:%S"))
+    return store
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Iterative stratification of multi-label data into folds (Sechidis et al. 2011),
+the algorithm behind iterstrat.MultilabelStratifiedKFold, vectorized over the
+label matrix.
+
+The reference implementation walks the samples one at a time. Here the samples
+(or groups) that carry the currently rarest label are placed together: the
+label's remaining per-fold demand is water-filled and the samples, in random
+order, are cut into consecutive runs of that size. That is one pass per label
+instead of one per sample. Optional groups (e.g. patients) are stratified as
+units, so all records of a group land in the same fold.
+'''
+import numpy as np
+
+
+def _water_fill(demand, amount):
+    '''
+    Split amount over folds, always topping up the fold with the largest remaining demand:
+    fold k gets max(0, demand[k] - t) with t chosen so that the parts sum to amount.
+    '''
+    s = np.sort(demand)[::-1]
+    cs = np.cumsum(s)
+    j = np.arange(1, len(s) + 1)
+    t = (cs - amount) / j
+    nxt = np.append(s[1:], -np.inf)
+    k = np.flatnonzero(t >= nxt)[0]
+    return np.maximum(demand - t[k], 0)
+
+
+def _cut(weights, parts, order):
+    '''
+    Assign items (in the given order) to folds so that fold k receives about parts[k] of the total
+    weight: item i goes to the fold whose cumulative interval holds the middle of item i.
+    '''
+    middle = np.cumsum(weights[order]) - weights[order] / 2.
+    bounds = np.cumsum(parts)[:-1]
+    folds = np.empty(len(order), dtype=np.int64)
+    folds[order] = np.searchsorted(bounds, middle, side='right')
+    return folds
+
+
+def iterative_stratification(y, kfold=5, groups=None, folds=None, seed=None):
+    '''
+    :param y: (N, num_classes) binary label matrix
+    :param groups: optional (N,) group id, records of one group always share a fold
+    :param folds: optional (N,) initial folds, -1 for records to assign; the others are kept
+                  and counted against the targets (incremental assignment)
+    :param seed: random seed of the tie breaking order
+    :return: (N,) fold of every record
+    '''
+    y = np.asarray(y)
+    n = len(y)
+    rng = np.random.RandomState(seed)
+
+    # units: groups, or single records
+    if groups is None:
+        inverse = np.arange(n)
+        Y = (y > 0).astype(np.float64)
+        size = np.ones(n)
+    else:
+        _, inverse = np.unique(np.asarray(groups), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        Y = np.add.reduceat((y[order] > 0).astype(np.float64), starts, axis=0)
+        size = np.diff(np.r_[starts, n]).astype(np.float64)
+    units = len(Y)
+
+    unit_folds = np.full(units, -1, dtype=np.int64)
+    if folds is not None:
+        folds = np.asarray(folds)
+        fixed = folds >= 0
+        unit_folds[inverse[fixed]] = folds[fixed]
+
+    # remaining demand of every fold, per label and in records
+    demand = np.tile(Y.sum(axis=0) / kfold, (kfold, 1))
+    demand_size = np.full(kfold, size.sum() / kfold)
+    assigned = unit_folds >= 0
+    for k in range(kfold):
+        demand[k] -= Y[unit_folds == k].sum(axis=0)
+        demand_size[k] -= size[unit_folds == k].sum()
+
+    has = np.asfortranarray(Y > 0)
+    remaining = has[~assigned].sum(axis=0).astype(np.int64)
+    while remaining.any():
+        # the rarest label that still has unassigned units, ties broken at random
+        candidates = np.flatnonzero(remaining == remaining[remaining > 0].min())
+        label = candidates[rng.randint(len(candidates))]
+        idx = np.flatnonzero(has[:, label] & ~assigned)
+
+        weights = Y[idx, label]
+        parts = _water_fill(demand[:, label], weights.sum())
+        # folds with the same label demand are ordered by their remaining size demand
+        fold_order = np.lexsort((rng.rand(kfold), -demand_size, -demand[:, label]))
+        cut = _cut(weights, parts[fold_order], rng.permutation(len(idx)))
+        chosen = fold_order[cut]
+
+        unit_folds[idx] = chosen
+        assigned[idx] = True
+        remaining -= has[idx].sum(axis=0)
+        for k in range(kfold):
+            members = idx[chosen == k]
+            demand[k] -= Y[members].sum(axis=0)
+            demand_size[k] -= size[members].sum()
+
+    # units without any label only balance the fold sizes
+    idx = np.flatnonzero(~assigned)
+    if len(idx):
+        parts = _water_fill(demand_size, size[idx].sum())
+        fold_order = np.lexsort((rng.rand(kfold), -demand_size))
+        unit_folds[idx] = fold_order[_cut(size[idx], parts[fold_order], rng.permutation(len(idx)))]
+
+    return unit_folds[inverse]
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+'''
+The modules live at the top level of the repository and utils.py reads
+./evaluation/weights.csv at import, so the tests run from the repository root.
+'''
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+The vectorized scoring functions (metrics.py) against the loop implementations
+of the official scorer in evaluation/, and utils.compute_beta_score against its
+loop version.
+
+    python -m pytest tests
+'''
+import numpy as np
+import pytest
+
+import metrics
+import evaluate_12ECG_score
+import utils
+from benchmark import official_scorer, compute_beta_score_loops, synthetic_labels
+
+NUM_CLASSES = 27
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return official_scorer()
+
+
+def confusion_cases():
+    rng = np.random.RandomState(0)
+    cases = [pytest.param(np.zeros((5, NUM_CLASSES)), np.zeros((5, NUM_CLASSES)), id='no positives'),
+             pytest.param(np.ones((5, NUM_CLASSES)), np.ones((5, NUM_CLASSES)), id='all positive'),
+             pytest.param(np.ones((5, NUM_CLASSES)), np.zeros((5, NUM_CLASSES)), id='all positive labels, no outputs'),
+             pytest.param(np.eye(NUM_CLASSES), np.eye(NUM_CLASSES), id='identity'),
+             pytest.param(np.zeros((0, NUM_CLASSES)), np.zeros((0, NUM_CLASSES)), id='no recordings')]
+    for n in (1, 7, 300):
+        for p in (0.02, 0.1, 0.5):
+            labels = rng.rand(n, NUM_CLASSES) < p
+            # an empty class and an all-positive column
+            labels[:, 0], labels[:, 1] = False, True
+            for q in (0.1, 0.6):
+                cases.append(pytest.param(labels, rng.rand(n, NUM_CLASSES) < q, id='random n=%d p=%g q=%g' % (n, p, q)))
+    return cases
+
+
+@pytest.mark.parametrize('labels,outputs', confusion_cases())
+@pytest.mark.parametrize('cast', (np.bool_, np.int64, np.float64))
+def test_modified_confusion_matrix(reference, labels, outputs, cast):
+    labels, outputs = labels.astype(cast), outputs.astype(cast)
+    a = metrics.compute_modified_confusion_matrix(labels, outputs)
+    b = reference.compute_modified_confusion_matrix(labels, outputs)
+    assert a.shape == b.shape
+    np.testing.assert_allclose(a, b, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('labels,outputs', [c for c in confusion_cases() if len(c.values[0])])
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_challenge_metric(reference, labels, outputs):
+    rng = np.random.RandomState(1)
+    weights = rng.rand(NUM_CLASSES, NUM_CLASSES)
+    weights[np.diag_indices(NUM_CLASSES)] = 1
+    classes = [str(c) for c in range(NUM_CLASSES)]
+    a = evaluate_12ECG_score.compute_challenge_metric(weights, labels, outputs, classes, '22')
+    b = reference.compute_challenge_metric(weights, labels, outputs, classes, '22')
+    np.testing.assert_allclose(a, b, rtol=1e-12, atol=1e-12, equal_nan=True)
+
+
+def auc_cases():
+    rng = np.random.RandomState(2)
+    cases = []
+    for n in (1, 2, 9, 300):
+        labels = rng.rand(n, NUM_CLASSES) < 0.2
+        # a class without positives, one without negatives
+        labels[:, 0], labels[:, 1] = False, True
+        cases += [pytest.param(labels, rng.rand(n, NUM_CLASSES), id='continuous n=%d' % n),
+                  pytest.param(labels, np.round(rng.rand(n, NUM_CLASSES), 1), id='ties n=%d' % n),
+                  pytest.param(labels, labels * 1., id='outputs = labels n=%d' % n),
+                  pytest.param(labels, np.full((n, NUM_CLASSES), 0.5), id='constant n=%d' % n),
+                  pytest.param(labels, rng.randint(0, 3, (n, NUM_CLASSES)) / 2., id='three levels n=%d' % n)]
+    return cases
+
+
+@pytest.mark.parametrize('labels,outputs', auc_cases())
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_auc(reference, labels, outputs):
+    # classes without positives or negatives have NaN areas, and with one recording every class is one of them
+    a = metrics.compute_auc(labels, outputs)
+    b = reference.compute_auc(labels, outputs)
+    # same summation order, so the areas are identical, not only close
+    np.testing.assert_array_equal(np.array(a), np.array(b))
+
+
+def beta_cases():
+    rng = np.random.RandomState(3)
+    cases = []
+    for n in (1, 5, 300):
+        # np.eye has rows without labels when n > NUM_CLASSES, and columns without positives when n < NUM_CLASSES
+        for name, labels in (('synthetic', synthetic_labels(n, seed=n)), ('all positive', np.ones((n, NUM_CLASSES), dtype=np.uint8)),
+                             ('identity', np.eye(n, NUM_CLASSES, dtype=np.int64))):
+            cases += [pytest.param(labels, labels > 0, id='%s n=%d, outputs = labels' % (name, n)),
+                      pytest.param(labels, rng.rand(n, NUM_CLASSES) < 0.1, id='%s n=%d, sparse outputs' % (name, n)),
+                      pytest.param(labels, np.zeros(labels.shape, dtype=bool), id='%s n=%d, no outputs' % (name, n)),
+                      pytest.param(labels, rng.rand(n, NUM_CLASSES) < 0.7, id='%s n=%d, dense outputs' % (name, n))]
+    # recordings without labels weigh 1/0 in the loops, which turns the sums of their classes into inf or NaN
+    labels = synthetic_labels(20, seed=4)
+    labels[::3] = 0
+    cases += [pytest.param(labels, labels > 0, id='unlabelled rows, outputs = labels'),
+              pytest.param(labels, rng.rand(20, NUM_CLASSES) < 0.3, id='unlabelled rows, random outputs'),
+              pytest.param(np.zeros((4, NUM_CLASSES), dtype=np.uint8), rng.rand(4, NUM_CLASSES) < 0.5, id='no labels at all')]
+    return cases
+
+
+@pytest.mark.parametrize('labels,outputs', beta_cases())
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_beta_score(labels, outputs):
+    a = utils.compute_beta_score(labels, outputs, beta=2, num_classes=NUM_CLASSES)[:4]
+    b = compute_beta_score_loops(labels, outputs, beta=2, num_classes=NUM_CLASSES)
+    np.testing.assert_allclose(a, b, rtol=1e-12, atol=1e-12, equal_nan=True)
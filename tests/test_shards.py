@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+ShardedECGDataset over a few small shards written in the export_shards layout.
+'''
+import os
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from loader import _DATALOADER_ARGS
+from shards import ShardedECGDataset, SHARD_FILE, SHARD_INDEX
+from store import NUM_LEADS
+
+SIGLEN = 8
+NUM_CLASSES = 3
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    # 6 shards of 10 records, record i has signal value i
+    counts = [10] * 6
+    names = np.array(['R%03d' % i for i in range(sum(counts))])
+    start = 0
+    for shard, n in enumerate(counts):
+        with open(os.path.join(str(tmp_path), SHARD_FILE.format(shard)), 'wb') as f:
+            np.zeros((n, NUM_CLASSES), dtype=np.uint8).tofile(f)
+            sigs = np.arange(start, start + n, dtype=np.float32)[:, None, None] * np.ones((1, NUM_LEADS, SIGLEN), dtype=np.float32)
+            sigs.tofile(f)
+        start += n
+    np.savez(os.path.join(str(tmp_path), SHARD_INDEX), names=names, counts=np.array(counts, dtype=np.int64),
+             SIGLEN=SIGLEN, num_classes=NUM_CLASSES, signature='test')
+    data_path = os.path.join(str(tmp_path), 'fold.pth')
+    torch.save({'wc': np.full(NUM_CLASSES, 10.), 'names': names, 'train': np.arange(len(names)),
+                'val': np.arange(0)}, data_path)
+    # with batch_augment the samples are the stored signals, augmentation is left to the collate_fn
+    return ShardedECGDataset(data_path, str(tmp_path), train=True, batch_augment=True, buffer_size=8)
+
+
+def epoch_order(loader):
+    return [int(v) for x, target in loader for v in x[:, 0, 0].tolist()]
+
+
+@pytest.mark.skipif('persistent_workers' not in _DATALOADER_ARGS, reason='DataLoader without persistent_workers')
+def test_persistent_workers_reshuffle_every_epoch(dataset):
+    # default collate, so the records keep their signal value
+    loader = DataLoader(dataset, batch_size=4, num_workers=2, persistent_workers=True)
+    first, second = epoch_order(loader), epoch_order(loader)
+    assert sorted(first) == sorted(second) == list(range(60))
+    assert first != second
@@ -1,26 +1,33 @@
 #!/usr/bin/env python
 
 import numpy as np, os, sys, joblib
-from scipy.io import loadmat
+from matio import load_val
 from sklearn.impute import SimpleImputer
 from sklearn.ensemble import RandomForestClassifier
 from get_12ECG_features import get_12ECG_features
 
 import torch, time, os, shutil
+import multiprocessing
+from multiprocessing.connection import wait
 import models, utils, pytorchtools
 import numpy as np
 import pandas as pd
 from tensorboard_logger import Logger
 from torch import nn, optim
-from torch.utils.data import DataLoader
-from dataset import ECGDataset
+from dataset import ECGDataset, MultiFoldECGDataset
 from config import config
 from tqdm import tqdm
 import radam
 import random
-import scipy.io as sio
-from scipy import signal
-from split import split
+from split import split, load_fold
+from store import cached_store, SignalStore, SharedSignalCache
+from shards import export_shards, shard_dir, ShardedECGDataset
+from loader import make_loader
+import autotune
+import precision
+from header_index import load_header_index
+import preprocess
+from preprocess import Preprocessor
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -55,65 +62,127 @@ def save_ckpt_cv(state, is_best, model_save_dir,fold,model_directory):
         shutil.copyfile(current_w, model_w_cv)
 
 
-def train_epoch(model, optimizer, criterion, train_dataloader, show_interval=10):
+def train_epoch(model, optimizer, criterion, train_dataloader, show_interval=10, scaler=None):
+    # scaler: precision.grad_scaler, kept across epochs so fp16 keeps its loss scale
+    scaler = scaler or precision.grad_scaler(device)
     model.train()
-    f1_meter, loss_meter, it_count = 0, 0, 0
-    acc_meter,f1_meter,f2_meter,g2_meter = 0,0,0,0
-    cm_meter = 0
+    # metrics are computed once over the epoch, the progress lines show running values
+    meter = utils.MetricAccumulator(len(train_dataloader.dataset), config.num_classes, device)
     for inputs, target in train_dataloader:
+        # already on device (non_blocking) when the loader is a loader.DeviceLoader
         inputs = inputs.to(device)
-        target = target.to(device)
+        target = target.to(device).float()
         # zero the parameter gradients
         optimizer.zero_grad()
         # forward
-        output = model(inputs)
-        loss = criterion(output, target)
-        loss.backward()
-        optimizer.step()
-        loss_meter += loss.item()
-        it_count += 1
-
-        #f1 = utils.calc_f1(target, torch.sigmoid(output))
-        #f1_meter += f1
-        # acc, f1, f2, g2 = utils.calc_metric(target, torch.sigmoid(output))
-        acc, f1, f2, g2, cm = utils.calc_metric(target, torch.sigmoid(output))
-        acc_meter+= acc
-        f1_meter += f1
-        f2_meter += f2
-        g2_meter += g2
-        cm_meter += cm
-
-        if it_count != 0 and it_count % show_interval == 0:
-            print("%d,loss:%.3e acc:%.3f f1:%.3f f2:%.3f g2:%.3f cm:%.3f " % (it_count, loss.item(), acc,f1,f2,g2,cm))
-    return loss_meter / it_count, acc_meter / it_count,f1_meter / it_count,f2_meter / it_count,g2_meter / it_count,cm_meter / it_count
+        with precision.autocast(device):
+            output = model(inputs).float()
+            loss = criterion(output, target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        meter.update(output, target, loss)
+
+        if meter.steps % show_interval == 0:
+            print("%d,loss:%.3e acc:%.3f f1:%.3f (running)" % ((meter.steps,) + meter.running()))
+            if config.report_worker_memory:
+                utils.print_worker_memory()
+    return meter.compute()
 
 
 def val_epoch(model, criterion, val_dataloader, threshold=0.5):
     model.eval()
-    f1_meter, loss_meter, it_count = 0, 0, 0
-    acc_meter,f1_meter,f2_meter,g2_meter = 0,0,0,0
-    cm_meter = 0
+    meter = utils.MetricAccumulator(len(val_dataloader.dataset), config.num_classes, device, threshold)
     with torch.no_grad():
         for inputs, target in val_dataloader:
             inputs = inputs.to(device)
-            target = target.to(device)
-            output = model(inputs)
-            loss = criterion(output, target)
-            loss_meter += loss.item()
-            it_count += 1
-            output = torch.sigmoid(output)
+            target = target.to(device).float()
+            with precision.autocast(device):
+                output = model(inputs).float()
+                loss = criterion(output, target)
+            meter.update(output, target, loss)
+
+    return meter.compute()
+
+
+def train_epoch_folds(folds, train_dataloader, show_interval=10):
+    '''
+    One epoch of every fold model in folds (see train_cv_single_pass) over a shared (inputs, target, fold)
+    stream: fold model k steps on the samples of the batch outside fold k, so batch norm never sees its
+    held-out records either.
+    :return: train_epoch's metrics, per fold
+    '''
+    meters = []
+    for f in folds:
+        f['model'].train()
+        meters.append(utils.MetricAccumulator(len(train_dataloader.dataset), config.num_classes, device))
+    steps = 0
+    for inputs, target, fold in train_dataloader:
+        inputs = inputs.to(device)
+        target = target.to(device).float()
+        fold = fold.to(device)
+        for f, meter in zip(folds, meters):
+            keep = fold != f['fold']
+            # batch norm needs more than one sample
+            if int(keep.sum()) < 2:
+                continue
+            f['optimizer'].zero_grad()
+            with precision.autocast(device):
+                output = f['model'](inputs[keep]).float()
+                loss = f['criterion'](output, target[keep])
+            f['scaler'].scale(loss).backward()
+            f['scaler'].step(f['optimizer'])
+            f['scaler'].update()
+            meter.update(output, target[keep], loss)
+        steps += 1
+
+        if steps % show_interval == 0:
+            print("%d," % steps + " ".join("fold%d loss:%.3e acc:%.3f f1:%.3f" % ((f['fold'],) + meter.running())
+                                           for f, meter in zip(folds, meters)) + " (running)")
+            if config.report_worker_memory:
+                utils.print_worker_memory()
+    return [meter.compute() for meter in meters]
+
+
+def val_epoch_folds(folds, val_dataloader, threshold=0.5):
+    # one validation pass for all fold models, every record scored by the model of its own fold
+    counts = np.bincount(val_dataloader.dataset.folds, minlength=config.kfold)
+    meters = []
+    for f in folds:
+        f['model'].eval()
+        meters.append(utils.MetricAccumulator(counts[f['fold']], config.num_classes, device, threshold))
+    with torch.no_grad():
+        for inputs, target, fold in val_dataloader:
+            inputs = inputs.to(device)
+            target = target.to(device).float()
+            fold = fold.to(device)
+            for f, meter in zip(folds, meters):
+                keep = fold == f['fold']
+                if not bool(keep.any()):
+                    continue
+                with precision.autocast(device):
+                    output = f['model'](inputs[keep]).float()
+                    loss = f['criterion'](output, target[keep])
+                meter.update(output, target[keep], loss)
 
-            # f1 = utils.calc_f1(target, output, threshold)
-            # f1_meter += f1
-            # acc ,f1 ,f2 ,g2 = utils.calc_metric(target, output,threshold)
-            acc ,f1 ,f2 ,g2, cm = utils.calc_metric(target, output,threshold)
-            acc_meter+= acc
-            f1_meter += f1
-            f2_meter += f2
-            g2_meter += g2
-            cm_meter += cm
+    return [meter.compute() for meter in meters]
 
-    return loss_meter / it_count, acc_meter / it_count,f1_meter / it_count,f2_meter / it_count,g2_meter / it_count,cm_meter / it_count
+
+def build_ram_cache(input_directory, data_path):
+    # train and val records of data_path, decoded once into shared memory (None if config.ram_cache is off)
+    if not config.ram_cache or config.shards:
+        return None
+    names = torch.load(data_path)['names']
+    return SharedSignalCache(SignalStore(input_directory), config.ram_cache_bytes, fids=names)
+
+
+def build_dataset(data_path, input_directory, train, cache=None):
+    # ECGDataset over the store, or a ShardedECGDataset over its shards when config.shards is on
+    if config.shards:
+        return ShardedECGDataset(data_path, shard_dir(input_directory), train=train,
+                                 batch_augment=config.batch_augment, buffer_size=config.shuffle_buffer)
+    return ECGDataset(data_path=data_path, data_dir=input_directory, train=train, cache=cache,
+                      batch_augment=config.batch_augment)
 
 
 def train(input_directory,output_directory):
@@ -130,18 +199,25 @@ def train(input_directory,output_directory):
 
     model = model.to(device)
     # data
-    train_dataset = ECGDataset(data_path=config.train_data, data_dir=input_directory, train=True)
-    train_dataloader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True, num_workers=6)
-    val_dataset = ECGDataset(data_path=config.train_data, data_dir=input_directory, train=False)
-    val_dataloader = DataLoader(val_dataset, batch_size=config.batch_size, num_workers=4)
+    cache = build_ram_cache(input_directory, config.train_data)
+    train_dataset = build_dataset(config.train_data, input_directory, train=True, cache=cache)
+    w = torch.tensor(train_dataset.wc, dtype=torch.float).to(device)
+    criterion = utils.WeightedMultilabel(w) ##   # utils.FocalLoss() #
+    loading = autotune.loader_settings(train_dataset, model, criterion, device)
+    # sharded datasets shuffle themselves
+    train_dataloader = make_loader(train_dataset, device, batch_size=loading['batch_size'], shuffle=not config.shards,
+                                   num_workers=loading['num_workers'], collate_fn=train_dataset.collate_fn,
+                                   prefetch_factor=loading['prefetch_factor'])
+    val_dataset = build_dataset(config.train_data, input_directory, train=False, cache=cache)
+    val_dataloader = make_loader(val_dataset, device, batch_size=loading['batch_size'], num_workers=loading['val_num_workers'],
+                                 prefetch_factor=loading['prefetch_factor'])
 
     print("train_datasize", len(train_dataset), "val_datasize", len(val_dataset))
     # optimizer and loss
     #optimizer = optim.Adam(model.parameters(), lr=config.lr)
     optimizer = radam.RAdam(model.parameters(), lr=config.lr, weight_decay=1e-4) #config.lr
     #optimizer = optim.SGD(model.parameters(), lr=0.1, momentum=0.9, dampening=0, weight_decay=1e-4, nesterov=False)
-    w = torch.tensor(train_dataset.wc, dtype=torch.float).to(device)
-    criterion = utils.WeightedMultilabel(w) ##   # utils.FocalLoss() #
+    scaler = precision.grad_scaler(device)
 
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', verbose=True, factor=0.1, patience=5, min_lr=1e-06, eps=1e-08)#CosineAnnealingLR  CosineAnnealingWithRestartsLR
     #scheduler = pytorchtools.CosineAnnealingWithRestartsLR(optimizer,T_max=30, T_mult = 1.2, eta_min=1e-6)
@@ -183,7 +259,7 @@ def train(input_directory,output_directory):
     # =========>开始训练<=========
     for epoch in range(start_epoch, config.max_epoch + 1):
         since = time.time()
-        train_loss, train_acc, train_f1, train_f2, train_g2,train_cm = train_epoch(model, optimizer, criterion, train_dataloader, show_interval=100)
+        train_loss, train_acc, train_f1, train_f2, train_g2,train_cm = train_epoch(model, optimizer, criterion, train_dataloader, show_interval=100, scaler=scaler)
         val_loss, val_acc, val_f1, val_f2, val_g2, val_cm = val_epoch(model, criterion, val_dataloader)
 
         # train_loss, train_f1 = train_beat_epoch(model, optimizer, criterion, train_dataloader, show_interval=100)
@@ -232,200 +308,403 @@ def train(input_directory,output_directory):
             print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
             break
 
-def train_cv(input_directory,output_directory):
-    # model
-    # 模型保存文件夹
-    model_save_dir = '%s/%s_%s' % (config.ckpt, config.model_name+"_cv",time.strftime("%Y%m%d%H%M"))#'%s/%s_%s' % (config.ckpt, args.model_name+"_cv", time.strftime("%Y%m%d%H%M"))
-    for fold in range(config.kfold):
-        print("***************************fold : {}***********************".format(fold))
-        model = getattr(models, config.model_name)(fold=fold)
-        # if args.ckpt and not args.resume:
-        #     state = torch.load(args.ckpt, map_location='cpu')
-        #     model.load_state_dict(state['state_dict'])
-        #     print('train with pretrained weight val_f1', state['f1'])
+def save_resume_cv(model_save_dir, fold, model, optimizer, scheduler, scaler, **progress):
+    # full training state of a fold (weights, optimizer, lr scheduler, loss scaler, early stopping),
+    # replaced atomically so that a crash never leaves a truncated file
+    resume_w = os.path.join(model_save_dir, config.resume_w_cv.format(fold))
+    state = dict(progress, state_dict=model.state_dict(), optimizer=optimizer.state_dict(),
+                 scheduler=scheduler.state_dict(), scaler=scaler.state_dict())
+    torch.save(state, resume_w + '.tmp')
+    os.replace(resume_w + '.tmp', resume_w)
+
+
+def fold_finished(model_save_dir, fold):
+    resume_w = os.path.join(model_save_dir, config.resume_w_cv.format(fold))
+    return os.path.isfile(resume_w) and torch.load(resume_w, map_location='cpu')['finished']
+
+
+def train_fold(fold, input_directory, output_directory, model_save_dir, cache=None, resume=False, loading=None,
+               logdir=None):
+    # one fold of train_cv; with resume, continued from its resume file in model_save_dir if there is one.
+    # loading: the autotune.loader_settings result when the caller already has it
+    # logdir: tensorboard directory, model_save_dir if None
+    print("***************************fold : {}***********************".format(fold))
+    model = getattr(models, config.model_name)(fold=fold)
+    # if args.ckpt and not args.resume:
+    #     state = torch.load(args.ckpt, map_location='cpu')
+    #     model.load_state_dict(state['state_dict'])
+    #     print('train with pretrained weight val_f1', state['f1'])
+
+    num_ftrs = model.fc.in_features
+    model.fc = nn.Linear(num_ftrs, config.num_classes)
+
+    #2019/11/11
+    #save dense/fc weight for pretrain 55 classes
+    # model = MyModel()
+    # num_ftrs = model.classifier.out_features
+    # model.fc = nn.Linear(55, config.num_classes)
+
+    model = model.to(device)
+    # data
+    train_dataset = build_dataset(config.train_data_cv.format(fold), input_directory, train=True, cache=cache)
+
+    w = torch.tensor(train_dataset.wc, dtype=torch.float).to(device)
+    criterion = utils.WeightedMultilabel(w) ## utils.FocalLoss() #
+    # tuned on the first fold, later folds read the saved result
+    loading = loading or autotune.loader_settings(train_dataset, model, criterion, device)
+
+    train_dataloader = make_loader(train_dataset, device,
+                                batch_size=loading['batch_size'],
+                                shuffle=not config.shards,
+                                drop_last=True,
+                                num_workers=loading['num_workers'],
+                                collate_fn=train_dataset.collate_fn,
+                                prefetch_factor=loading['prefetch_factor'])
+
+    val_dataset = build_dataset(config.train_data_cv.format(fold), input_directory, train=False, cache=cache)
+
+    val_dataloader = make_loader(val_dataset, device,
+                                batch_size=loading['batch_size'],
+                                drop_last=True,
+                                num_workers=loading['val_num_workers'],
+                                prefetch_factor=loading['prefetch_factor'])
+
+    print("fold_{}_train_datasize".format(fold), len(train_dataset), "fold_{}_val_datasize".format(fold), len(val_dataset))
+    # optimizer and loss
+    optimizer = radam.RAdam(model.parameters(), lr=config.lr) #optim.Adam(model.parameters(), lr=config.lr)
+    scaler = precision.grad_scaler(device)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', verbose=True, factor=0.1, patience=5, min_lr=1e-06, eps=1e-08)
+
+    # if args.ex: model_save_dir += args.ex
+    # best_f1 = -1
+    # lr = config.lr
+    # start_epoch = 1
+    # stage = 1
+
+    best_f1 = -1
+    best_cm = -1
+    lr = config.lr
+    start_epoch = 1
+    stage = 1
+    epoch_cum = 0
+    # 从上一个断点，继续训练: 本fold在model_save_dir中的resume文件(每个epoch更新)
+    resume_w = os.path.join(model_save_dir, config.resume_w_cv.format(fold))
+    if resume and os.path.isfile(resume_w):
+        state = torch.load(resume_w, map_location='cpu')
+        model.load_state_dict(state['state_dict'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        scaler.load_state_dict(state['scaler'])
+        start_epoch = state['epoch'] + 1
+        best_cm, epoch_cum, lr, stage = state['best_cm'], state['epoch_cum'], state['lr'], state['stage']
+        print("=> fold {} resumed from epoch {}".format(fold, state['epoch']))
+    logger = Logger(logdir=logdir or model_save_dir, flush_secs=2)
+    # =========>开始训练<=========
+    for epoch in range(start_epoch, config.max_epoch + 1):
+        since = time.time()
+        train_loss, train_acc, train_f1, train_f2, train_g2, train_cm = train_epoch(model, optimizer, criterion, train_dataloader, show_interval=100, scaler=scaler)
+        val_loss, val_acc, val_f1, val_f2, val_g2, val_cm = val_epoch(model, criterion, val_dataloader)
+
+        # train_loss, train_f1 = train_beat_epoch(model, optimizer, criterion, train_dataloader, show_interval=100)
+        # val_loss, val_f1 = val_beat_epoch(model, criterion, val_dataloader)
 
-        num_ftrs = model.fc.in_features
-        model.fc = nn.Linear(num_ftrs, config.num_classes)
+        print('#epoch:%02d, stage:%d, train_loss:%.3e, train_acc:%.3f, train_f1:%.3f, train_f2:%.3f, train_g2:%.3f,train_cm:%.3f,\n \
+                val_loss:%0.3e, val_acc:%.3f, val_f1:%.3f, val_f2:%.3f, val_g2:%.3f, val_cm:%.3f,time:%s\n'
+              % (epoch, stage, train_loss, train_acc,train_f1,train_f2,train_g2,train_cm, \
+                val_loss, val_acc, val_f1, val_f2, val_g2, val_cm,utils.print_time_cost(since)))
 
-        #2019/11/11
-        #save dense/fc weight for pretrain 55 classes
-        # model = MyModel()
-        # num_ftrs = model.classifier.out_features
-        # model.fc = nn.Linear(55, config.num_classes)
+        logger.log_value('fold{}_train_loss'.format(fold),  train_loss, step=epoch)
+        logger.log_value('fold{}_train_f1'.format(fold), train_f1, step=epoch)
+        logger.log_value('fold{}_val_loss'.format(fold),  val_loss, step=epoch)
+        logger.log_value('fold{}_val_f1'.format(fold),  val_f1, step=epoch)
+        state = {"state_dict": model.state_dict(), "epoch": epoch, "loss": val_loss, 'f1': val_f1, 'lr': lr,
+                 'stage': stage}
+
+
+        save_ckpt_cv(state, best_cm < val_cm, model_save_dir,fold,output_directory)
+        best_cm = max(best_cm, val_cm)
+
+        scheduler.step(val_cm)
+        # scheduler.step()
+
+        if val_cm < best_cm:
+            epoch_cum += 1
+        else:
+            epoch_cum = 0
+        save_resume_cv(model_save_dir, fold, model, optimizer, scheduler, scaler, epoch=epoch, best_cm=best_cm,
+                       epoch_cum=epoch_cum, lr=lr, stage=stage, finished=epoch_cum >= 12 or epoch == config.max_epoch)
+
+        # save_ckpt_cv(state, best_f1 < val_f1, model_save_dir,fold)
+        # best_f1 = max(best_f1, val_f1)
+
+        # if val_f1 < best_f1:
+        #     epoch_cum += 1
+        # else:
+        #     epoch_cum = 0
+
+        # if epoch in config.stage_epoch:
+        # if epoch_cum == 5:
+        #     stage += 1
+        #     lr /= config.lr_decay
+        #     if lr < 1e-6:
+        #         lr = 1e-6
+        #         print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
+        #     best_w = os.path.join(model_save_dir, config.best_w_cv.format(fold))
+        #     model.load_state_dict(torch.load(best_w)['state_dict'])
+        #     print("*" * 10, "step into stage%02d lr %.3ef" % (stage, lr))
+        #     utils.adjust_learning_rate(optimizer, lr)
+
+        # elif epoch_cum >= 12:
+        #     print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
+        #     break
 
+        if epoch_cum >= 12:
+            print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
+            break
+        # if epoch in config.stage_epoch:
+        #     stage += 1
+        #     lr /= config.lr_decay
+        #     best_w = os.path.join(model_save_dir, config.best_w_cv.format(fold))
+        #     model.load_state_dict(torch.load(best_w)['state_dict'])
+        #     print("*" * 10, "step into stage%02d lr %.3ef" % (stage, lr))
+        #     utils.adjust_learning_rate(optimizer, lr)
+
+
+def _fold_process(fold, input_directory, output_directory, model_save_dir, cache, threads, cpus, resume, loading):
+    # entry of a fold process started by run_folds: its own cores and intra-op threads, output into fold{k}.log
+    sys.stdout = sys.stderr = open(os.path.join(model_save_dir, 'fold{}.log'.format(fold)), 'a', buffering=1)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    # event files are named after the second they are opened in, so concurrent folds log into fold{k}/
+    train_fold(fold, input_directory, output_directory, model_save_dir, cache, resume, loading,
+               logdir=os.path.join(model_save_dir, 'fold{}'.format(fold)))
+
+
+def _tune_process(fold, input_directory, cache, threads, cpus, conn):
+    # started by run_folds before the fold processes: autotune.loader_settings on the share of the cores
+    # one fold process gets, sent back through conn
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    model = getattr(models, config.model_name)(fold=fold)
+    model.fc = nn.Linear(model.fc.in_features, config.num_classes)
+    model = model.to(device)
+    train_dataset = build_dataset(config.train_data_cv.format(fold), input_directory, train=True, cache=cache)
+    criterion = utils.WeightedMultilabel(torch.tensor(train_dataset.wc, dtype=torch.float).to(device))
+    conn.send(autotune.loader_settings(train_dataset, model, criterion, device))
+
+
+def run_folds(folds, input_directory, output_directory, model_save_dir, cache=None, resume=False):
+    '''
+    Train folds as config.fold_workers concurrent processes. The usable cores are split into one slice per
+    process (its affinity, DataLoader workers included) with config.fold_threads (default: the slice size)
+    intra-op threads. A fold whose process dies is started again up to config.fold_retries times and
+    continues from its resume file; the first attempt of a fold resumes only with resume.
+    With config.autotune, the loaders are tuned once before any fold starts and every fold uses the result.
+    Each fold writes its output to model_save_dir/fold{k}.log and its tensorboard log to model_save_dir/fold{k}/.
+    '''
+    # fork: the processes (and their DataLoader workers) share the RAM cache; CUDA is first touched in them
+    ctx = multiprocessing.get_context('fork')
+    workers = min(config.fold_workers, len(folds))
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    per_fold = max(1, (len(cpus) or os.cpu_count()) // workers)
+    threads = config.fold_threads or per_fold
+    # no pinning with fewer cores than processes
+    slots = [cpus[slot * per_fold:(slot + 1) * per_fold] if len(cpus) >= workers else None for slot in range(workers)]
+
+    loading = None
+    if config.autotune:
+        # in a process of its own, so that this one never initializes CUDA before forking the folds
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_tune_process, name='autotune',
+                              args=(folds[0], input_directory, cache, threads, slots[0], sender))
+        process.start()
+        sender.close()
+        try:
+            loading = receiver.recv()
+        except EOFError:
+            loading = None
+        process.join()
+        if loading is None:
+            raise RuntimeError("train_cv: loader autotuning exited with code {}".format(process.exitcode))
+
+    pending, running, failed = list(folds), {}, []
+    attempts = dict.fromkeys(folds, 0)
+    while pending or running:
+        for slot in range(workers):
+            if slot not in running and pending:
+                fold = pending.pop(0)
+                attempts[fold] += 1
+                process = ctx.Process(target=_fold_process, name='fold{}'.format(fold),
+                                      args=(fold, input_directory, output_directory, model_save_dir, cache,
+                                            threads, slots[slot], resume or attempts[fold] > 1, loading))
+                process.start()
+                running[slot] = (fold, process)
+                print("fold {} started: pid {}, {} threads, log {}".format(
+                    fold, process.pid, threads, os.path.join(model_save_dir, 'fold{}.log'.format(fold))))
+        wait([process.sentinel for _, process in running.values()])
+        for slot, (fold, process) in list(running.items()):
+            if process.exitcode is None:
+                continue
+            del running[slot]
+            if process.exitcode == 0:
+                print("fold {} finished".format(fold))
+            elif attempts[fold] <= config.fold_retries:
+                print("fold {} exited with code {}, resuming it".format(fold, process.exitcode))
+                pending.append(fold)
+            else:
+                print("fold {} exited with code {}, giving up after {} attempts".format(fold, process.exitcode, attempts[fold]))
+                failed.append(fold)
+    if failed:
+        raise RuntimeError("train_cv: folds {} failed, see their logs in {}".format(failed, model_save_dir))
+
+
+def train_cv_single_pass(input_directory, output_directory, model_save_dir, cache=None, resume=False):
+    '''
+    All folds of train_cv in one process over one data stream (config.cv_single_pass): every batch is read
+    and augmented once for all k fold models instead of once per fold, and validation is a single pass too.
+    Checkpoints and resume files are the same per fold files as train_fold writes; the tensorboard values of
+    all folds go into one event file in model_save_dir, under the same per fold tags.
+    :param resume: continue every fold from its resume file in model_save_dir
+    '''
+    if config.shards:
+        raise ValueError("cv_single_pass reads the signal store, it does not support config.shards")
+    data_paths = [config.train_data_cv.format(fold) for fold in range(config.kfold)]
+    train_dataset = MultiFoldECGDataset(data_paths, input_directory, train=True, cache=cache,
+                                        batch_augment=config.batch_augment)
+    val_dataset = MultiFoldECGDataset(data_paths, input_directory, train=False, cache=cache)
+
+    logger = Logger(logdir=model_save_dir, flush_secs=2)
+    folds = []
+    for fold in range(config.kfold):
+        model = getattr(models, config.model_name)(fold=fold)
+        model.fc = nn.Linear(model.fc.in_features, config.num_classes)
         model = model.to(device)
-        # data
-        train_dataset = ECGDataset(data_path=config.train_data_cv.format(fold),data_dir=input_directory,train=True)
-
-        train_dataloader = DataLoader(train_dataset,
-                                    batch_size=config.batch_size,
-                                    shuffle=True,
-                                    drop_last=True,
-                                    num_workers=6)
-
-        val_dataset = ECGDataset(data_path=config.train_data_cv.format(fold),data_dir=input_directory,train=False)
-
-        val_dataloader = DataLoader(val_dataset,
-                                    batch_size=config.batch_size,
-                                    drop_last=True,
-                                    num_workers=4)
-
-        print("fold_{}_train_datasize".format(fold), len(train_dataset), "fold_{}_val_datasize".format(fold), len(val_dataset))
-        # optimizer and loss
-        optimizer = radam.RAdam(model.parameters(), lr=config.lr) #optim.Adam(model.parameters(), lr=config.lr)
-        w = torch.tensor(train_dataset.wc, dtype=torch.float).to(device)
-        criterion = utils.WeightedMultilabel(w) ## utils.FocalLoss() #
-        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', verbose=True, factor=0.1, patience=5, min_lr=1e-06, eps=1e-08)
-
-        # if args.ex: model_save_dir += args.ex
-        # best_f1 = -1
-        # lr = config.lr
-        # start_epoch = 1
-        # stage = 1
-
-        best_f1 = -1
-        best_cm = -1
-        lr = config.lr
-        start_epoch = 1
-        stage = 1
-        # 从上一个断点，继续训练
-#         if args.resume:
-#             if os.path.exists(args.ckpt):  # 这里是存放权重的目录
-#                 model_save_dir = args.ckpt
-#                 current_w = torch.load(os.path.join(args.ckpt, config.current_w))
-#                 best_w = torch.load(os.path.join(model_save_dir, config.best_w))
-#                 best_f1 = best_w['loss']
-#                 start_epoch = current_w['epoch'] + 1
-#                 lr = current_w['lr']
-#                 stage = current_w['stage']
-#                 model.load_state_dict(current_w['state_dict'])
-#                 # 如果中断点恰好为转换stage的点
-#                 if start_epoch - 1 in config.stage_epoch:
-#                     stage += 1
-#                     lr /= config.lr_decay
-#                     utils.adjust_learning_rate(optimizer, lr)
-#                     model.load_state_dict(best_w['state_dict'])
-#                 print("=> loaded checkpoint (epoch {})".format(start_epoch - 1))
-        logger = Logger(logdir=model_save_dir, flush_secs=2)
-        # =========>开始训练<=========
-        for epoch in range(start_epoch, config.max_epoch + 1):
-            since = time.time()
-            train_loss, train_acc, train_f1, train_f2, train_g2, train_cm = train_epoch(model, optimizer, criterion, train_dataloader, show_interval=100)
-            val_loss, val_acc, val_f1, val_f2, val_g2, val_cm = val_epoch(model, criterion, val_dataloader)
-
-            # train_loss, train_f1 = train_beat_epoch(model, optimizer, criterion, train_dataloader, show_interval=100)
-            # val_loss, val_f1 = val_beat_epoch(model, criterion, val_dataloader)
-
-            print('#epoch:%02d, stage:%d, train_loss:%.3e, train_acc:%.3f, train_f1:%.3f, train_f2:%.3f, train_g2:%.3f,train_cm:%.3f,\n \
-                    val_loss:%0.3e, val_acc:%.3f, val_f1:%.3f, val_f2:%.3f, val_g2:%.3f, val_cm:%.3f,time:%s\n'
-                  % (epoch, stage, train_loss, train_acc,train_f1,train_f2,train_g2,train_cm, \
-                    val_loss, val_acc, val_f1, val_f2, val_g2, val_cm,utils.print_time_cost(since)))
+        optimizer = radam.RAdam(model.parameters(), lr=config.lr)
+        f = {'fold': fold, 'model': model, 'optimizer': optimizer, 'scaler': precision.grad_scaler(device),
+             'scheduler': optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', verbose=True, factor=0.1, patience=5, min_lr=1e-06, eps=1e-08),
+             'criterion': utils.WeightedMultilabel(torch.tensor(train_dataset.fold_wc[fold], dtype=torch.float).to(device)),
+             'best_cm': -1, 'epoch_cum': 0, 'lr': config.lr, 'stage': 1, 'next_epoch': 1, 'finished': False}
+        resume_w = os.path.join(model_save_dir, config.resume_w_cv.format(fold))
+        if resume and os.path.isfile(resume_w):
+            state = torch.load(resume_w, map_location='cpu')
+            model.load_state_dict(state['state_dict'])
+            optimizer.load_state_dict(state['optimizer'])
+            f['scheduler'].load_state_dict(state['scheduler'])
+            f['scaler'].load_state_dict(state['scaler'])
+            f.update(best_cm=state['best_cm'], epoch_cum=state['epoch_cum'], lr=state['lr'], stage=state['stage'],
+                     next_epoch=state['epoch'] + 1, finished=state['finished'])
+            print("=> fold {} resumed from epoch {}".format(fold, state['epoch']))
+        folds.append(f)
+
+    # tuned on one fold model, the stream feeds all of them
+    loading = autotune.loader_settings(train_dataset, folds[0]['model'], folds[0]['criterion'], device)
+    train_dataloader = make_loader(train_dataset, device, batch_size=loading['batch_size'], shuffle=True, drop_last=True,
+                                   num_workers=loading['num_workers'], collate_fn=train_dataset.collate_fn,
+                                   prefetch_factor=loading['prefetch_factor'])
+    val_dataloader = make_loader(val_dataset, device, batch_size=loading['batch_size'],
+                                 num_workers=loading['val_num_workers'], prefetch_factor=loading['prefetch_factor'])
+    print("single pass over {} folds, train_datasize {} val_datasize {}".format(config.kfold, len(train_dataset), len(val_dataset)))
+
+    # =========>开始训练<=========
+    for epoch in range(min(f['next_epoch'] for f in folds), config.max_epoch + 1):
+        # folds that stopped early drop out, the others keep sharing the stream
+        active = [f for f in folds if not f['finished'] and f['next_epoch'] <= epoch]
+        if not active:
+            break
+        since = time.time()
+        train_metrics = train_epoch_folds(active, train_dataloader, show_interval=100)
+        val_metrics = val_epoch_folds(active, val_dataloader)
+
+        for f, (train_loss, train_acc, train_f1, train_f2, train_g2, train_cm), \
+                (val_loss, val_acc, val_f1, val_f2, val_g2, val_cm) in zip(active, train_metrics, val_metrics):
+            fold = f['fold']
+            print('#fold:%d, epoch:%02d, stage:%d, train_loss:%.3e, train_acc:%.3f, train_f1:%.3f, train_f2:%.3f, train_g2:%.3f,train_cm:%.3f,\n \
+                    val_loss:%0.3e, val_acc:%.3f, val_f1:%.3f, val_f2:%.3f, val_g2:%.3f, val_cm:%.3f'
+                  % (fold, epoch, f['stage'], train_loss, train_acc,train_f1,train_f2,train_g2,train_cm, \
+                    val_loss, val_acc, val_f1, val_f2, val_g2, val_cm))
 
             logger.log_value('fold{}_train_loss'.format(fold),  train_loss, step=epoch)
             logger.log_value('fold{}_train_f1'.format(fold), train_f1, step=epoch)
             logger.log_value('fold{}_val_loss'.format(fold),  val_loss, step=epoch)
             logger.log_value('fold{}_val_f1'.format(fold),  val_f1, step=epoch)
-            state = {"state_dict": model.state_dict(), "epoch": epoch, "loss": val_loss, 'f1': val_f1, 'lr': lr,
-                     'stage': stage}
-
+            state = {"state_dict": f['model'].state_dict(), "epoch": epoch, "loss": val_loss, 'f1': val_f1, 'lr': f['lr'],
+                     'stage': f['stage']}
 
-            save_ckpt_cv(state, best_cm < val_cm, model_save_dir,fold,output_directory)
-            best_cm = max(best_cm, val_cm)
+            save_ckpt_cv(state, f['best_cm'] < val_cm, model_save_dir,fold,output_directory)
+            f['best_cm'] = max(f['best_cm'], val_cm)
 
-            scheduler.step(val_cm)
-            # scheduler.step()
+            f['scheduler'].step(val_cm)
 
-            if val_cm < best_cm:
-                epoch_cum += 1
+            if val_cm < f['best_cm']:
+                f['epoch_cum'] += 1
             else:
-                epoch_cum = 0
-
-            # save_ckpt_cv(state, best_f1 < val_f1, model_save_dir,fold)
-            # best_f1 = max(best_f1, val_f1)
-
-            # if val_f1 < best_f1:
-            #     epoch_cum += 1
-            # else:
-            #     epoch_cum = 0
-
-            # if epoch in config.stage_epoch:
-            # if epoch_cum == 5:
-            #     stage += 1
-            #     lr /= config.lr_decay
-            #     if lr < 1e-6:
-            #         lr = 1e-6
-            #         print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
-            #     best_w = os.path.join(model_save_dir, config.best_w_cv.format(fold))
-            #     model.load_state_dict(torch.load(best_w)['state_dict'])
-            #     print("*" * 10, "step into stage%02d lr %.3ef" % (stage, lr))
-            #     utils.adjust_learning_rate(optimizer, lr)
-
-            # elif epoch_cum >= 12:
-            #     print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
-            #     break
-
-            if epoch_cum >= 12:
-                print("*" * 20, "step into stage%02d lr %.3ef" % (stage, lr))
-                break
-            # if epoch in config.stage_epoch:
-            #     stage += 1
-            #     lr /= config.lr_decay
-            #     best_w = os.path.join(model_save_dir, config.best_w_cv.format(fold))
-            #     model.load_state_dict(torch.load(best_w)['state_dict'])
-            #     print("*" * 10, "step into stage%02d lr %.3ef" % (stage, lr))
-            #     utils.adjust_learning_rate(optimizer, lr)
-
-def transform_sig(path,FS=500,SIGLEN=500*10):
-
-    files = []
-
-    for file in os.listdir(path):
-        # if 'I' not in file:
-        #    continue
-        if file.endswith('.mat'):
-            files.append(path +"/"+file.split(".")[0])
-
-
-    for file in tqdm(files[:]):
-
-        sig = sio.loadmat(file+'.mat')["val"]#(12,5000)
-        # print(sig.shape)
-        # print(sig)
-        with open(file+'.hea','r') as f:
-            header_data=f.readlines()
-
-        fs = int(header_data[0].split(' ')[2])
-        siglen = int(header_data[0].split(' ')[3])
-        adc_gain = int(header_data[1].split(' ')[2].split('/')[0])
-
-        # print(fs,siglen,adc_gain)
-
-        if fs == FS * 2 :
-            # sig = signal.resample(sig.T, int(annot.siglen/annot.fs * FS)).T
-            sig = sig[:,::2]
-        elif fs == FS:
-            pass#raise ValueError("fs wrong")
-        elif fs != FS:
-            sig = signal.resample(sig.T, int(siglen/fs * FS)).T
-
-        siglen = sig.shape[1]
-        # print(siglen)
-
-        if siglen !=  SIGLEN:
-            sig_ext = np.zeros([12,SIGLEN])
-
-        if siglen <  SIGLEN:
-            sig_ext[:,:siglen] = sig
-        if siglen >  SIGLEN:
-            sig_ext = sig[:,:SIGLEN]
-
-        if siglen !=  SIGLEN:
-            sig = sig_ext
-
-        sig = sig/adc_gain
-
-        shutil.copyfile(file+'.hea','./post_data/'+file.split('//')[-1]+'.hea')
-        sio.savemat('./post_data/'+file.split('//')[-1]+'.mat', {'val': sig})
+                f['epoch_cum'] = 0
+            if f['epoch_cum'] >= 12:
+                print("*" * 20, "fold %d step into stage%02d lr %.3ef" % (fold, f['stage'], f['lr']))
+            f['next_epoch'] = epoch + 1
+            f['finished'] = f['epoch_cum'] >= 12 or epoch == config.max_epoch
+            save_resume_cv(model_save_dir, fold, f['model'], f['optimizer'], f['scheduler'], f['scaler'], epoch=epoch,
+                           best_cm=f['best_cm'], epoch_cum=f['epoch_cum'], lr=f['lr'], stage=f['stage'],
+                           finished=f['finished'])
+        print('#epoch:%02d, folds:%s, time:%s' % (epoch, ','.join(str(f['fold']) for f in active), utils.print_time_cost(since)))
+
+
+def new_save_dir(prefix):
+    # prefix_%Y%m%d%H%M, with a _2, _3... suffix for runs started in the same minute; never an existing directory
+    model_save_dir = '%s_%s' % (prefix, time.strftime("%Y%m%d%H%M"))
+    for n in range(1, 1000):
+        path = model_save_dir if n == 1 else '%s_%d' % (model_save_dir, n)
+        try:
+            os.makedirs(path)
+            return path
+        except FileExistsError:
+            continue
+    raise RuntimeError("no free model directory for {}".format(model_save_dir))
+
+
+def train_cv(input_directory,output_directory):
+    # model
+    # 模型保存文件夹, config.resume_dir时继续之前的训练, 否则新建
+    resume = bool(config.resume_dir)
+    if resume:
+        model_save_dir = config.resume_dir
+        utils.mkdirs(model_save_dir)
+        folds = [fold for fold in range(config.kfold) if not fold_finished(model_save_dir, fold)]
+        if len(folds) < config.kfold:
+            print("train_cv: folds {} already finished in {}".format(sorted(set(range(config.kfold)) - set(folds)), model_save_dir))
+        if not folds:
+            return
+    else:
+        model_save_dir = new_save_dir('%s/%s' % (config.ckpt, config.model_name+"_cv"))#'%s/%s_%s' % (config.ckpt, args.model_name+"_cv", time.strftime("%Y%m%d%H%M"))
+        folds = list(range(config.kfold))
+    # every fold covers the same records, so one shared cache serves all of them
+    cache = build_ram_cache(input_directory, config.train_data_cv.format(0))
+    if config.cv_single_pass:
+        train_cv_single_pass(input_directory, output_directory, model_save_dir, cache, resume)
+        return
+    if config.fold_workers > 1 and len(folds) > 1:
+        run_folds(folds, input_directory, output_directory, model_save_dir, cache, resume)
+        return
+    for fold in folds:
+        train_fold(fold, input_directory, output_directory, model_save_dir, cache, resume)
+
+
+def transform_sig(path,cache_dir,FS=500,SIGLEN=500*10):
+
+    # sorted by record name, so that the store layout is stable across runs and can be resumed in place
+    headers = load_header_index(path, cache_dir)
+    files = headers.paths()
+
+    # all records go into one N x 12 x SIGLEN float32 memmap instead of one .mat per record,
+    # preprocessed in parallel and resumable; the store persists in cache_dir across runs and
+    # records whose files are unchanged are not redone.
+    # records are handed to the workers in chunks of one sampling rate for Preprocessor.batch
+    preprocessor = Preprocessor(FS, SIGLEN, headers=headers)
+    return cached_store(files, path, cache_dir, preprocessor.load_batch, FS=FS, SIGLEN=SIGLEN,
+                        version=preprocess.VERSION, max_bytes=config.cache_max_bytes,
+                        workers=config.preprocess_workers, progress=tqdm, groups=headers.fs)
 
 def train_12ECG_classifier(input_directory, output_directory):
     # Load data.
@@ -434,11 +713,9 @@ def train_12ECG_classifier(input_directory, output_directory):
     # config.train_dir = input_directory#'./post_data'
     # config.test_dir = input_directory#'./post_data'
 
-    config.train_dir = './post_data'
-    config.test_dir = './post_data'
-    if not os.path.isdir(config.train_dir):
-        os.mkdir(config.train_dir)
-    transform_sig(input_directory)
+    store = transform_sig(input_directory, config.cache_dir)
+    config.train_dir = store.store_dir
+    config.test_dir = store.store_dir
 
     config.model = output_directory
 
@@ -450,7 +727,11 @@ def train_12ECG_classifier(input_directory, output_directory):
 
     print(config.train_dir)
 
-    split(config.train_dir)
+    split(input_directory)
+    if config.shards:
+        # every fold file holds the labels of all records
+        dd = load_fold(config.train_data)
+        export_shards(store, dd['names'], dd['labels'], config.shard_records)
 
     if TRAIN:
         # train(input_directory,output_directory)
@@ -462,20 +743,14 @@ def train_12ECG_classifier(input_directory, output_directory):
     # Save model.
     print('Saving model...')
 
-    if os.path.isdir(config.train_dir):
-        # os.rmdir(config.train_dir)
-        try:
-            shutil.rmtree(config.train_dir)
-        except:
-            print("can not delete ./post_data/")
+    # the preprocessed store stays in config.cache_dir for the next run
 
 # Load challenge data.
 def load_challenge_data(header_file):
     with open(header_file, 'r') as f:
         header = f.readlines()
     mat_file = header_file.replace('.hea', '.mat')
-    x = loadmat(mat_file)
-    recording = np.asarray(x['val'], dtype=np.float64)
+    recording = np.asarray(load_val(mat_file), dtype=np.float64)
     return recording, header
 
 # Find unique classes.
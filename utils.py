@@ -12,6 +12,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from config import config
+from metrics import compute_modified_confusion_matrix
 import pandas as pd
 
 weights_file = './evaluation/weights.csv'
@@ -221,74 +222,39 @@ def compute_beta_score(labels, output, beta, num_classes, check_errors=True):
         if len(output) != len(labels):
             raise Exception('Numbers of outputs and labels must be the same.')
 
-    # Populate contingency table.
-    num_recordings = len(labels)
-
-    fbeta_l = np.zeros(num_classes)
-    gbeta_l = np.zeros(num_classes)
-    fmeasure_l = np.zeros(num_classes)
-    accuracy_l = np.zeros(num_classes)
-
-    f_beta = 0
-    g_beta = 0
-    f_measure = 0
-    accuracy = 0
-
-    # Weight function
-    C_l=np.ones(num_classes);
-
-    for j in range(num_classes):
-        tp = 0
-        fp = 0
-        fn = 0
-        tn = 0
-
-        for i in range(num_recordings):
-            
-            num_labels = np.sum(labels[i])
-        
-            if labels[i][j] and output[i][j]:
-                tp += 1/num_labels
-            elif not labels[i][j] and output[i][j]:
-                fp += 1/num_labels
-            elif labels[i][j] and not output[i][j]:
-                fn += 1/num_labels
-            elif not labels[i][j] and not output[i][j]:
-                tn += 1/num_labels
-
-        # Summarize contingency table.
-        if ((1+beta**2)*tp + (fn*beta**2) + fp):
-            fbeta_l[j] = float((1+beta**2)* tp) / float(((1+beta**2)*tp) + (fn*beta**2) + fp)
-        else:
-            fbeta_l[j] = 1.0
-
-        if (tp + fp + beta * fn):
-            gbeta_l[j] = float(tp) / float(tp + fp + beta*fn)
-        else:
-            gbeta_l[j] = 1.0
-
-        if tp + fp + fn + tn:
-            accuracy_l[j] = float(tp + tn) / float(tp + fp + fn + tn)
-        else:
-            accuracy_l[j] = 1.0
-
-        if 2 * tp + fp + fn:
-            fmeasure_l[j] = float(2 * tp) / float(2 * tp + fp + fn)
-        else:
-            fmeasure_l[j] = 1.0
-
-
-    for i in range(num_classes):
-        f_beta += fbeta_l[i]*C_l[i]
-        g_beta += gbeta_l[i]*C_l[i]
-        f_measure += fmeasure_l[i]*C_l[i]
-        accuracy += accuracy_l[i]*C_l[i]
-
-
-    f_beta = float(f_beta)/float(num_classes)
-    g_beta = float(g_beta)/float(num_classes)
-    f_measure = float(f_measure)/float(num_classes)
-    accuracy = float(accuracy)/float(num_classes)
+    # Populate contingency table: every recording counts 1/(its number of labels),
+    # for all classes at once.
+    labels = np.asarray(labels)
+    output = np.asarray(output)
+    num_labels = labels.sum(axis=1)
+    counted = num_labels != 0
+    weight = 1. / num_labels[counted]
+    L = labels[counted, :num_classes] != 0
+    O = output[counted, :num_classes] != 0
+
+    tp = np.dot(weight, (L & O).astype(np.float64))
+    fp = np.dot(weight, O.astype(np.float64)) - tp
+    fn = np.dot(weight, L.astype(np.float64)) - tp
+    tn = weight.sum() - tp - fp - fn
+    if not counted.all():
+        # a recording without labels weighs 1/0 = inf
+        fp[np.any(output[~counted, :num_classes] != 0, axis=0)] = np.inf
+        tn[np.any(output[~counted, :num_classes] == 0, axis=0)] = np.inf
+
+    # Summarize contingency tables, 1.0 where a measure is undefined.
+    def ratio(numerator, denominator):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator != 0, numerator / denominator, 1.0)
+
+    fbeta_l = ratio((1+beta**2)*tp, ((1+beta**2)*tp) + (fn*beta**2) + fp)
+    gbeta_l = ratio(tp, tp + fp + beta*fn)
+    accuracy_l = ratio(tp + tn, tp + fp + fn + tn)
+    fmeasure_l = ratio(2 * tp, 2 * tp + fp + fn)
+
+    f_beta = float(fbeta_l.sum())/float(num_classes)
+    g_beta = float(gbeta_l.sum())/float(num_classes)
+    f_measure = float(fmeasure_l.sum())/float(num_classes)
+    accuracy = float(accuracy_l.sum())/float(num_classes)
 
 
     return accuracy,f_measure,f_beta,g_beta,compute_challenge_metric(weights,labels,output,scored_classes,[426783006])
@@ -302,27 +268,6 @@ def compute_beta_score(labels, output, beta, num_classes, check_errors=True):
 
 #     return compute_beta_score(y_true, y_pre,beta=2,num_classes=config.num_classes)
 
-# Compute modified confusion matrix for multi-class, multi-label tasks.
-def compute_modified_confusion_matrix(labels, outputs):
-    # Compute a binary multi-class, multi-label confusion matrix, where the rows
-    # are the labels and the columns are the outputs.
-    num_recordings, num_classes = np.shape(labels)
-    A = np.zeros((num_classes, num_classes))
-
-    # Iterate over all of the recordings.
-    for i in range(num_recordings):
-        # Calculate the number of positive labels and/or outputs.
-        normalization = float(max(np.sum(np.any((labels[i, :], outputs[i, :]), axis=0)), 1))
-        # Iterate over all of the classes.
-        for j in range(num_classes):
-            # Assign full and/or partial credit for each positive class.
-            if labels[i, j]:
-                for k in range(num_classes):
-                    if outputs[i, k]:
-                        A[j, k] += 1.0/normalization
-
-    return A
-
 # Compute the evaluation metric for the Challenge.
 def compute_challenge_metric(weights, labels, outputs, classes, normal_class):
     num_recordings, num_classes = np.shape(labels)
@@ -359,6 +304,57 @@ def calc_metric(y_true, y_pre, threshold=0.5):
 
     return compute_beta_score(y_true, y_pre,beta=2,num_classes=config.num_classes)
 
+#按epoch汇总的指标
+class MetricAccumulator(object):
+    """
+    Collects the logits and targets of one epoch into buffers preallocated on the model's device
+    (no host sync per batch) and computes calc_metric once over the whole epoch.
+    running() gives cheap running loss / element accuracy / micro-F1 for the progress lines.
+    """
+    def __init__(self, size, num_classes, device, threshold=0.5):
+        self.threshold = threshold
+        # sigmoid(x) > threshold  <=>  x > logit(threshold)
+        self.logit_threshold = float(np.log(threshold / (1 - threshold)))
+        self.logits = torch.empty((size, num_classes), dtype=torch.float32, device=device)
+        self.targets = torch.empty((size, num_classes), dtype=torch.uint8, device=device)
+        self.counts = torch.zeros(3, dtype=torch.int64, device=device)  # tp, fp, fn
+        self.loss = torch.zeros((), dtype=torch.float64, device=device)
+        self.size, self.steps = 0, 0
+
+    def update(self, output, target, loss):
+        '''
+        :param output: (B, num_classes) logits
+        :param target: (B, num_classes) 0/1 targets
+        :param loss: loss tensor of the batch
+        '''
+        output, target, n = output.detach(), target.detach(), len(output)
+        if self.size + n > len(self.logits):
+            # more samples than announced (e.g. an IterableDataset without exact length)
+            grow = (max(n, len(self.logits)), self.logits.shape[1])
+            self.logits = torch.cat([self.logits, self.logits.new_empty(grow)])
+            self.targets = torch.cat([self.targets, self.targets.new_empty(grow)])
+        self.logits[self.size:self.size + n] = output
+        self.targets[self.size:self.size + n] = target
+        self.size += n
+        self.steps += 1
+        self.loss += loss.detach()
+        pred, true = output > self.logit_threshold, target > 0
+        self.counts += torch.stack([(pred & true).sum(), (pred & ~true).sum(), (~pred & true).sum()])
+
+    def running(self):
+        ''':return: mean batch loss, element accuracy and micro-F1 so far'''
+        tp, fp, fn = self.counts.tolist()
+        elements = max(self.size * self.logits.shape[1], 1)
+        return (self.loss.item() / max(self.steps, 1), 1. - float(fp + fn) / elements,
+                2. * tp / max(2 * tp + fp + fn, 1))
+
+    def compute(self):
+        ''':return: mean batch loss, then acc, f1, f2, g2 and challenge metric of the whole epoch'''
+        y_true = self.targets[:self.size].cpu().numpy().astype(np.int64)
+        y_pre = self.logits[:self.size].cpu().numpy() > self.logit_threshold
+        return (self.loss.item() / max(self.steps, 1),) + \
+            tuple(compute_beta_score(y_true, y_pre, beta=2, num_classes=self.logits.shape[1]))
+
 def mkdirs(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -403,6 +399,47 @@ def print_time_cost(since):
     time_elapsed = time.time() - since
     return '{:.0f}m{:.0f}s\n'.format(time_elapsed // 60, time_elapsed % 60)
 
+#DataLoader worker的内存占用
+def process_memory(pid):
+    '''
+    :return: {'rss': MB, 'anon': MB, 'shared': MB} of one process read from /proc (Linux only), None if unavailable
+    '''
+    fields = {}
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for l in f:
+                key, _, value = l.partition(':')
+                if key in ('VmRSS', 'RssAnon', 'RssFile', 'RssShmem'):
+                    fields[key] = int(value.split()[0]) / 1024
+    except OSError:
+        return None
+    return {'rss': fields.get('VmRSS', 0), 'anon': fields.get('RssAnon', 0),
+            'shared': fields.get('RssFile', 0) + fields.get('RssShmem', 0)}
+
+
+def worker_memory(pid=None):
+    '''
+    Resident memory of the child processes of pid (the DataLoader workers), read from /proc (Linux only).
+    :return: {child pid: process_memory(child)}; copy-on-write growth shows up in anon
+    '''
+    pid = pid or os.getpid()
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        return {}
+    usage = {child: process_memory(child) for child in children}
+    return {child: u for child, u in usage.items() if u is not None}
+
+
+def print_worker_memory():
+    usage = worker_memory()
+    if usage:
+        print("workers rss(MB): " + " ".join("{}:{:.0f}(anon {:.0f})".format(pid, u['rss'], u['anon'])
+                                           for pid, u in sorted(usage.items())))
+
 
 # 调整学习率
 def adjust_learning_rate(optimizer, lr):